@@ -0,0 +1,92 @@
+from contextlib import contextmanager
+from metrics import increment
+import threading
+import time
+# Per-process circuit breakers for Postgres, Redis and outbound HTTP. After CIRCUIT_FAILURE_THRESHOLD consecutive failures
+# a dependency's circuit opens and calls fail at once with CircuitOpenError instead of each waiting out a timeout.
+# After CIRCUIT_OPEN_SECONDS one probe call is let through (half-open). Its success closes the circuit, its failure reopens it.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_OPEN_SECONDS = 10
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+_circuits = {}
+_circuits_lock = threading.Lock()
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+def get_http_failures() -> tuple:
+    """What counts as a failure for outbound HTTP. Error status codes are the caller's business."""
+    # requests is imported here so importing this module (and main) doesn't load it.
+    import requests
+    return (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+def _get_circuit(name: str) -> dict:
+    circuit = _circuits.get(name)
+    if circuit is None:
+        circuit = _circuits.setdefault(name, {'state': CIRCUIT_CLOSED, 'failures': 0, 'opened_at': 0.0, 'probe_started': 0.0})
+    return circuit
+
+
+def check_circuit(name: str) -> None:
+    """Raises CircuitOpenError if calls to name should fail fast. While half-open, lets one probe through at a time."""
+    circuit = _get_circuit(name)
+    if circuit['state'] == CIRCUIT_CLOSED:
+        return
+    with _circuits_lock:
+        now = time.monotonic()
+        if circuit['state'] == CIRCUIT_CLOSED:
+            return
+        if circuit['state'] == CIRCUIT_OPEN and now >= circuit['opened_at'] + CIRCUIT_OPEN_SECONDS:
+            circuit['state'] = CIRCUIT_HALF_OPEN
+            circuit['probe_started'] = now
+            return
+        if circuit['state'] == CIRCUIT_HALF_OPEN and now >= circuit['probe_started'] + CIRCUIT_OPEN_SECONDS:
+            # The last probe never reported back, so let another one through.
+            circuit['probe_started'] = now
+            return
+    raise CircuitOpenError(name + ' is unavailable, failing fast until the circuit closes.')
+
+
+def record_success(name: str) -> None:
+    circuit = _get_circuit(name)
+    if circuit['state'] == CIRCUIT_CLOSED and circuit['failures'] == 0:
+        return
+    with _circuits_lock:
+        if circuit['state'] != CIRCUIT_CLOSED:
+            print('Circuit for ' + name + ' closed.')
+        circuit['state'] = CIRCUIT_CLOSED
+        circuit['failures'] = 0
+
+
+def record_failure(name: str) -> None:
+    with _circuits_lock:
+        circuit = _get_circuit(name)
+        circuit['failures'] += 1
+        if circuit['state'] == CIRCUIT_HALF_OPEN or (circuit['state'] == CIRCUIT_CLOSED and circuit['failures'] >= CIRCUIT_FAILURE_THRESHOLD):
+            circuit['state'] = CIRCUIT_OPEN
+            circuit['opened_at'] = time.monotonic()
+            increment('circuit_breaker_opens_total', {'dependency': name})
+            print('Circuit for ' + name + ' opened after ' + str(circuit['failures']) + ' consecutive failure(s).')
+
+
+@contextmanager
+def circuit_breaker(name: str, failure_types: tuple = (Exception,)):
+    """Fails fast while name's circuit is open. Only failure_types count as failures, so caller bugs don't trip it."""
+    check_circuit(name)
+    try:
+        yield
+    except failure_types:
+        record_failure(name)
+        raise
+    record_success(name)
+
+
+def get_circuit_states() -> dict:
+    return {name: circuit['state'] for name, circuit in list(_circuits.items())}
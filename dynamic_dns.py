@@ -1,14 +1,62 @@
 from utils import get_api_key, append_to_log, authorized_via_redis_token
-import requests
+from redis_tools import get_redis_cursor, REDIS_HOST
+from metrics import dependency_timer
+from circuit_breaker import circuit_breaker, get_http_failures
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, TYPE_CHECKING
+import ipaddress
+import os
+import threading
+import time
 from flask import request
+if TYPE_CHECKING:
+    import requests
+NAMECHEAP_UPDATE_URL = os.environ.get('NAMECHEAP_UPDATE_URL', 'https://dynamicdns.park-your-domain.com/update')
+NAMECHEAP_GET_IP_URL = os.environ.get('NAMECHEAP_GET_IP_URL', 'https://dynamicdns.park-your-domain.com/getip')
+NAMECHEAP_TIMEOUT_SECONDS = 10
+NAMECHEAP_MAX_WORKERS = 8
+# The last IP pushed per record. Updates are skipped while the public IP still matches.
+DDNS_LAST_IP_KEY_PREFIX = 'ddns:last_ip:'
+DDNS_MAX_RECORDS = 100
 
+# Optional background monitor that pushes DDNS_MONITORED_RECORDS only when the public IP changes.
+# A Redis lock makes sure only one gunicorn worker polls per interval.
+DDNS_MONITOR_ENABLED = False
+DDNS_MONITOR_INTERVAL_SECONDS = 300
+DDNS_MONITORED_RECORDS = []
+DDNS_MONITOR_LOCK_KEY = 'ddns:monitor_lock'
 
-def update_dynamic_dns_namecheap(host: str, domain_name: str, ddns_password: str, ip: str) -> None:
+_namecheap_session = None
+_namecheap_session_pid = None
+_ip_monitor_pid = None
+_ip_monitor_lock = threading.Lock()
+
+
+def get_namecheap_session() -> 'requests.Session':
+    # main imports this module, so requests is only loaded once something actually calls Namecheap.
+    import requests
+    global _namecheap_session, _namecheap_session_pid
+    if _namecheap_session is None or _namecheap_session_pid != os.getpid():
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=NAMECHEAP_MAX_WORKERS))
+        _namecheap_session = session
+        _namecheap_session_pid = os.getpid()
+    return _namecheap_session
+
+
+def update_dynamic_dns_namecheap(host: str, domain_name: str, ddns_password: str, ip: str) -> bool:
     try:
-        requests.get(f'https://dynamicdns.park-your-domain.com/update?host={host}&domain={domain_name}&password={ddns_password}&ip={ip}')
-        append_to_log('flask_logs', 'DYNAMIC_DNS', 'INFO', f'Updated NameCheap DNS for {domain_name} with IP address {ip}.')
+        with circuit_breaker('namecheap', get_http_failures()), dependency_timer('namecheap'):
+            response = get_namecheap_session().get(NAMECHEAP_UPDATE_URL, params={'host': host, 'domain': domain_name, 'password': ddns_password, 'ip': ip}, timeout=NAMECHEAP_TIMEOUT_SECONDS)
+        # Namecheap answers 200 with an XML error count even when the update is rejected.
+        if response.status_code != 200 or '<ErrCount>0</ErrCount>' not in response.text:
+            append_to_log('flask_logs', 'DYNAMIC_DNS', 'ERROR', 'NameCheap rejected the update for ' + host + '.' + domain_name + ': ' + response.text[:500])
+            return False
+        append_to_log('flask_logs', 'DYNAMIC_DNS', 'INFO', f'Updated NameCheap DNS for {host}.{domain_name} with IP address {ip}.')
+        return True
     except Exception as e:
         append_to_log('flask_logs', 'DYNAMIC_DNS', 'ERROR', 'Exception thrown in update_dynamic_dns_namecheap: ' + repr(e))
+        return False
 
 
 def get_namecheap_password() -> str:
@@ -18,26 +66,112 @@ def get_namecheap_password() -> str:
         append_to_log('flask_logs', 'DYNAMIC_DNS', 'ERROR', 'Exception thrown in get_namecheap_password: ' + repr(e))
 
 
+def get_last_known_ip_key(host: str, domain_name: str) -> str:
+    return DDNS_LAST_IP_KEY_PREFIX + host + '.' + domain_name
+
+
+def update_record_if_changed(host: str, domain_name: str, ddns_password: str, ip: str, force: bool = False) -> str:
+    """Pushes the IP for one record unless Redis says it's already set. Returns 'updated', 'unchanged' or 'failed'."""
+    key = get_last_known_ip_key(host, domain_name)
+    r = None
+    try:
+        r = get_redis_cursor(host=REDIS_HOST)
+        if not force and r.get(key) == ip:
+            return 'unchanged'
+    except Exception as e:
+        append_to_log('flask_logs', 'DYNAMIC_DNS', 'WARNING', 'Last known IP cache unavailable, updating anyway: ' + repr(e))
+    if not update_dynamic_dns_namecheap(host, domain_name, ddns_password, ip):
+        return 'failed'
+    try:
+        if r is not None:
+            r.set(key, ip)
+    except Exception as e:
+        append_to_log('flask_logs', 'DYNAMIC_DNS', 'WARNING', 'Failed to save last known IP: ' + repr(e))
+    return 'updated'
+
+
+def update_records_if_changed(records: List[dict], force: bool = False) -> List[dict]:
+    """Looks up the public IP once and updates every host/domain_name pair concurrently. Returns a result per record."""
+    ip = get_public_ip()
+    if ip is None:
+        return [{'host': record['host'], 'domain_name': record['domain_name'], 'result': 'failed'} for record in records]
+    ddns_password = get_namecheap_password()
+    with ThreadPoolExecutor(max_workers=min(NAMECHEAP_MAX_WORKERS, max(len(records), 1))) as executor:
+        results = list(executor.map(lambda record: update_record_if_changed(record['host'], record['domain_name'], ddns_password, ip, force), records))
+    return [{'host': records[i]['host'], 'domain_name': records[i]['domain_name'], 'ip': ip, 'result': results[i]} for i in range(0, len(records))]
+
+
 def update_namecheap_dns_record():
     try:
         if not authorized_via_redis_token(request, 'ddns'):
             return ('', 401)
-        
-        ddns_password = get_namecheap_password()
+
         host = request.args.get('host')
         domain_name = request.args.get('domain_name')
-        ip = get_public_ip()
-        update_dynamic_dns_namecheap(host, domain_name, ddns_password, ip)
-        return ('', 200)
+        force = request.args.get('force') == 'True'
+        result = update_records_if_changed([{'host': host, 'domain_name': domain_name}], force)[0]
+        return ('', 500) if result['result'] == 'failed' else ('', 200)
     except Exception as e:
-        append_to_log('flask_logs', 'DYNAMIC_DNS', 'ERROR', 'Exception thrown in get_namecheap_password: ' + repr(e))
+        append_to_log('flask_logs', 'DYNAMIC_DNS', 'ERROR', 'Exception thrown in update_namecheap_dns_record: ' + repr(e))
+        return ('', 500)
+
+
+def update_namecheap_dns_records():
+    """
+    POST endpoint.
+    JSON keys:
+        records: list of objects with host and domain_name
+        force: 'True' to push even if the IP hasn't changed
+    """
+    try:
+        if not authorized_via_redis_token(request, 'ddns'):
+            return ('', 401)
+
+        json_body = request.json
+        records = json_body.get('records')
+        if not isinstance(records, list) or len(records) > DDNS_MAX_RECORDS or not all(isinstance(record, dict) and record.get('host') and record.get('domain_name') for record in records):
+            return ('JSON must contain a records list of at most ' + str(DDNS_MAX_RECORDS) + ' objects with host and domain_name.', 400)
+        results = update_records_if_changed([{'host': str(record['host']), 'domain_name': str(record['domain_name'])} for record in records], json_body.get('force') == 'True')
+        return ({'records': results}, 500 if any(result['result'] == 'failed' for result in results) else 200)
+    except Exception as e:
+        append_to_log('flask_logs', 'DYNAMIC_DNS', 'ERROR', 'Exception thrown in update_namecheap_dns_records: ' + repr(e))
         return ('', 500)
 
 
-def get_public_ip() -> str:
+def get_public_ip() -> Optional[str]:
     try:
-        response = requests.get('https://dynamicdns.park-your-domain.com/getip')
-        return response.text
+        with circuit_breaker('namecheap', get_http_failures()), dependency_timer('namecheap'):
+            response = get_namecheap_session().get(NAMECHEAP_GET_IP_URL, timeout=NAMECHEAP_TIMEOUT_SECONDS)
+        # An error page must never be pushed as the record's address.
+        if response.status_code != 200:
+            append_to_log('flask_logs', 'DYNAMIC_DNS', 'ERROR', 'Public IP lookup returned status ' + str(response.status_code) + '.')
+            return None
+        try:
+            return str(ipaddress.ip_address(response.text.strip()))
+        except ValueError:
+            append_to_log('flask_logs', 'DYNAMIC_DNS', 'ERROR', 'Public IP lookup returned something other than an IP address: ' + response.text[:200])
+            return None
     except Exception as e:
         append_to_log('flask_logs', 'DYNAMIC_DNS', 'ERROR', 'Exception thrown in get_public_ip: ' + repr(e))
-        return None
\ No newline at end of file
+        return None
+
+
+def run_ip_monitor() -> None:
+    while True:
+        try:
+            if DDNS_MONITORED_RECORDS and get_redis_cursor(host=REDIS_HOST).set(DDNS_MONITOR_LOCK_KEY, str(os.getpid()), nx=True, ex=DDNS_MONITOR_INTERVAL_SECONDS - 1):
+                update_records_if_changed(DDNS_MONITORED_RECORDS)
+        except Exception as e:
+            append_to_log('flask_logs', 'DYNAMIC_DNS', 'ERROR', 'Exception thrown in run_ip_monitor: ' + repr(e))
+        time.sleep(DDNS_MONITOR_INTERVAL_SECONDS)
+
+
+def start_ip_monitor() -> None:
+    # Threads don't survive fork, so each gunicorn worker starts its own on its first request. The Redis lock keeps polling to one per interval.
+    global _ip_monitor_pid
+    if not DDNS_MONITOR_ENABLED or _ip_monitor_pid == os.getpid():
+        return
+    with _ip_monitor_lock:
+        if _ip_monitor_pid != os.getpid():
+            threading.Thread(target=run_ip_monitor, name='ddns-ip-monitor', daemon=True).start()
+            _ip_monitor_pid = os.getpid()
@@ -1,60 +1,207 @@
 from flask import Response, request
-from mailjet_rest import Client
 from redis_tools import get_secrets_dict
-from utils import append_to_log, get_postgres_cursor_autocommit, get_postgres_timestamp_now, execute_postgres_query, get_sql_formatted_list, get_uuid, authorized_via_redis_token
-import pandas as pd
-from typing import Optional, Iterable
+from metrics import dependency_timer
+from circuit_breaker import circuit_breaker, CircuitOpenError, get_http_failures
+from response_cache import cached_response, invalidate_cache_tags
+from live_events import publish_event, OUTBOX_NAMESPACE
+from utils import append_to_log, get_postgres_cursor_autocommit, get_postgres_timestamp_now, get_uuid, authorized_via_redis_token, insert_postgres_rows
+from typing import Optional, Iterable, List, TYPE_CHECKING
+import json
+import sqlalchemy
+import requests
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+if TYPE_CHECKING:
+   import pandas as pd
 GMAIL_OUTGOING_EMAIL_TABLE = 'outgoing_emails'
+# Pollers lease messages instead of marking them sent up front. Unacked leases expire and the messages are handed out again.
+GMAIL_CLAIM_DEFAULT_LIMIT = 50
+GMAIL_CLAIM_MAX_LIMIT = 500
+GMAIL_LEASE_SECONDS = 300
+# The read-only outbox view is cached under the table name. Every write to the table invalidates it.
+OUTBOX_CACHE_SECONDS = 30
+OUTBOX_QUERY_DEFAULT_LIMIT = 100
+OUTBOX_QUERY_MAX_LIMIT = 1000
+
+# Mailjet v3.1 accepts at most 50 messages per send request.
+MAILJET_API_URL = os.environ.get('MAILJET_API_URL', 'https://api.mailjet.com/v3.1/send')
+MAILJET_BATCH_SIZE = 50
+MAILJET_MAX_WORKERS = 4
+MAILJET_TIMEOUT_SECONDS = 15
+MAILJET_MAX_ATTEMPTS = 3
+MAILJET_RETRY_BACKOFF_SECONDS = 1
+# Only retried when Mailjet can't have accepted the batch. A read timeout or reset after sending may mean it was
+# accepted, so those messages are reported 'unknown' and not sent again.
+MAILJET_RETRY_STATUS_CODES = [429, 503]
+
+_mailjet_session = None
+_mailjet_session_pid = None
+_mailjet_session_lock = threading.Lock()
+_mailjet_executor = None
+_mailjet_executor_pid = None
+_mailjet_executor_lock = threading.Lock()
+
+# Leasing needs these on the outgoing_emails table. Apply them with python log_tools.py --schema.
+EMAIL_SCHEMA_DDL = [
+   'alter table ' + GMAIL_OUTGOING_EMAIL_TABLE + ' add column if not exists lease_id text',
+   'alter table ' + GMAIL_OUTGOING_EMAIL_TABLE + ' add column if not exists lease_expires timestamptz',
+   'create index if not exists outgoing_emails_unsent_idx on ' + GMAIL_OUTGOING_EMAIL_TABLE + ' (created_timestamp) where sent_timestamp is null'
+]
             
 
+def build_mailjet_message(from_email, from_name, to_email, to_name, subject, text_part, html_part, custom_id: Optional[str] = None) -> dict:
+   message = {
+      "From": {
+            "Email": from_email,
+            "Name": from_name
+      },
+      "To": [
+            {
+                  "Email": to_email,
+                  "Name": to_name
+            }
+      ],
+      "Subject": subject,
+      "TextPart": text_part
+   }
+   if html_part is not None:
+      message['HTMLPart'] = html_part
+   if custom_id:
+      message['CustomID'] = custom_id
+   return message
+
+
+def get_mailjet_session() -> requests.Session:
+   # One keep-alive session per process shared by all sender threads.
+   global _mailjet_session, _mailjet_session_pid
+   if _mailjet_session is None or _mailjet_session_pid != os.getpid():
+      with _mailjet_session_lock:
+         if _mailjet_session is None or _mailjet_session_pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=MAILJET_MAX_WORKERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _mailjet_session = session
+            _mailjet_session_pid = os.getpid()
+   return _mailjet_session
+
+
+def get_mailjet_executor() -> ThreadPoolExecutor:
+   # One sender pool per process, reused across deliveries. Its threads start on demand.
+   global _mailjet_executor, _mailjet_executor_pid
+   if _mailjet_executor is None or _mailjet_executor_pid != os.getpid():
+      with _mailjet_executor_lock:
+         if _mailjet_executor is None or _mailjet_executor_pid != os.getpid():
+            _mailjet_executor = ThreadPoolExecutor(max_workers=MAILJET_MAX_WORKERS, thread_name_prefix='mailjet-sender')
+            _mailjet_executor_pid = os.getpid()
+   return _mailjet_executor
+
+
+def get_mailjet_auth() -> tuple:
+   secrets_dict = get_secrets_dict()
+   return (secrets_dict['secrets']['mailjet']['api_key'], secrets_dict['secrets']['mailjet']['api_secret'])
+
+
+def send_mailjet_batch(messages: List[dict], auth: tuple) -> List[dict]:
+   """
+   Sends up to MAILJET_BATCH_SIZE messages in one v3.1 request, retrying with backoff only when the batch can't have been accepted.
+   Returns one result per message, in order, with status 'success', 'error' or 'unknown' (Mailjet may have accepted it).
+   """
+   for attempt in range(0, MAILJET_MAX_ATTEMPTS):
+      try:
+         with circuit_breaker('mailjet', get_http_failures()), dependency_timer('mailjet'):
+            response = get_mailjet_session().post(MAILJET_API_URL, json={'Messages': messages}, auth=auth, timeout=MAILJET_TIMEOUT_SECONDS)
+         if response.status_code in MAILJET_RETRY_STATUS_CODES:
+            error = 'Mailjet returned status code ' + str(response.status_code)
+         elif response.status_code >= 500:
+            return [{'custom_id': message.get('CustomID'), 'status': 'unknown', 'response': response.text} for message in messages]
+         else:
+            # v3.1 answers 400 when any message in the batch is rejected, but still reports each message separately.
+            message_results = response.json().get('Messages', [])
+            if len(message_results) == len(messages):
+               return [{'custom_id': messages[i].get('CustomID'), 'status': message_results[i].get('Status', 'error'), 'response': message_results[i]} for i in range(0, len(messages))]
+            return [{'custom_id': message.get('CustomID'), 'status': 'error', 'response': response.text} for message in messages]
+      except (requests.exceptions.ConnectTimeout, CircuitOpenError) as e:
+         # Nothing was sent.
+         error = repr(e)
+      except Exception as e:
+         append_to_log('flask_logs', 'EMAIL_TOOLS', 'ERROR', 'Mailjet batch may or may not have been accepted, not retrying: ' + repr(e))
+         return [{'custom_id': message.get('CustomID'), 'status': 'unknown', 'response': repr(e)} for message in messages]
+      append_to_log('flask_logs', 'EMAIL_TOOLS', 'WARNING', 'Mailjet batch attempt ' + str(attempt + 1) + ' failed: ' + error)
+      if attempt + 1 < MAILJET_MAX_ATTEMPTS:
+         time.sleep(MAILJET_RETRY_BACKOFF_SECONDS * (2 ** attempt))
+   return [{'custom_id': message.get('CustomID'), 'status': 'error', 'response': error} for message in messages]
+
+
+def send_mailjet_messages(messages: List[dict], auth: Optional[tuple] = None) -> List[dict]:
+   """
+   Splits messages into Mailjet's 50-per-request batches and sends them from a bounded thread pool. A single batch is sent inline.
+   Returns one result per message in the original order.
+   """
+   if not messages:
+      return []
+   if auth is None:
+      auth = get_mailjet_auth()
+   batches = [messages[i:i + MAILJET_BATCH_SIZE] for i in range(0, len(messages), MAILJET_BATCH_SIZE)]
+   if len(batches) == 1:
+      batch_results = [send_mailjet_batch(batches[0], auth)]
+   else:
+      batch_results = list(get_mailjet_executor().map(lambda batch: send_mailjet_batch(batch, auth), batches))
+   results = [result for batch in batch_results for result in batch]
+   append_to_log('flask_logs', 'EMAIL_TOOLS', 'TRACE', lambda: 'Mailjet delivered ' + str(sum(1 for result in results if result['status'] == 'success')) + ' of ' + str(len(results)) + ' messages in ' + str(len(batches)) + ' batches.')
+   return results
+
+
 def send_mailjet_message(from_email, from_name, to_email, to_name, subject, text_part, html_part):
    try:
-      secrets_dict = get_secrets_dict()
-      mailjet = Client(auth=(secrets_dict['secrets']['mailjet']['api_key'], secrets_dict['secrets']['mailjet']['api_secret']), version='v3.1')
-      data = {
-      'Messages': [
-                  {
-                        "From": {
-                              "Email": from_email,
-                              "Name": from_name
-                        },
-                        "To": [
-                              {
-                                    "Email": to_email,
-                                    "Name": to_name
-                              }
-                        ],
-                        "Subject": subject,
-                        "TextPart": text_part,
-                        "HTMLPart": html_part
-                  }
-            ]
-      }
-      result = mailjet.send.create(data=data)
-      append_to_log('flask_logs', 'EMAIL_TOOLS', 'TRACE', 'Mailjet status code: ' + str(result.status_code) + ' Mailjet JSON: ' + str(result.json()))
+      result = send_mailjet_messages([build_mailjet_message(from_email, from_name, to_email, to_name, subject, text_part, html_part)])[0]
+      append_to_log('flask_logs', 'EMAIL_TOOLS', 'TRACE', 'Mailjet status: %s Mailjet JSON: %s', result['status'], result['response'])
    except Exception as e:
       append_to_log('flask_logs', 'EMAIL_TOOLS', 'ERROR', repr(e))
 
 
+def deliver_queued_messages_via_mailjet(from_email: str, from_name: str, limit: int = GMAIL_CLAIM_MAX_LIMIT) -> dict:
+   """
+   Leases queued outgoing emails, sends them through Mailjet in batches and acks the ones Mailjet accepted.
+   Rejected messages stay unsent and are retried once their lease expires. Messages Mailjet may have accepted are acked
+   too, and logged, so they are never sent twice.
+   """
+   lease_id, rows = claim_gmail_messages(limit)
+   messages = [build_mailjet_message(from_email, from_name, row['recipient_address'], row['recipient_address'], row['subject'], row['text_body'], None, custom_id=row['message_id']) for row in rows]
+   results = send_mailjet_messages(messages)
+   sent_ids = [result['custom_id'] for result in results if result['status'] == 'success']
+   unknown_ids = [result['custom_id'] for result in results if result['status'] == 'unknown']
+   if unknown_ids:
+      append_to_log('flask_logs', 'EMAIL_TOOLS', 'ERROR', 'Marked sent without confirmation from Mailjet, check delivery of: ' + ', '.join(unknown_ids))
+   if sent_ids or unknown_ids:
+      ack_gmail_messages(lease_id, sent_ids + unknown_ids)
+   return {'claimed': len(rows), 'sent': len(sent_ids), 'unknown': len(unknown_ids), 'failed': len(rows) - len(sent_ids) - len(unknown_ids)}
+
+
 def queue_gmail_message(module: str, recipient: str, subject: str, body: str) -> str:
    try:
-      with get_postgres_cursor_autocommit('cjremmett') as cursor:
-         message_id = get_uuid()
-         email = pd.DataFrame({
-            'created_timestamp': [get_postgres_timestamp_now()],
-            'module': [module],
-            'recipient_address': [recipient],
-            'subject': [subject],
-            'text_body': [body],
-            'message_id': [message_id]
-         })
-         email.to_sql(name='outgoing_emails', con=cursor, if_exists='append', index=False)
-         return message_id
+      message_id = get_uuid()
+      insert_postgres_rows(GMAIL_OUTGOING_EMAIL_TABLE, {
+         'created_timestamp': get_postgres_timestamp_now(),
+         'module': module,
+         'recipient_address': recipient,
+         'subject': subject,
+         'text_body': body,
+         'message_id': message_id
+      })
+      invalidate_cache_tags([GMAIL_OUTGOING_EMAIL_TABLE])
+      publish_event(OUTBOX_NAMESPACE, 'queued', {'module': module, 'count': 1, 'message_ids': [message_id]})
+      return message_id
    except Exception as e:
       append_to_log('flask_logs', 'EMAIL_TOOLS', 'ERROR', repr(e))
 
 
-def get_queued_gmail_messages(unsent_only: Optional[bool] = True) -> pd.DataFrame:
+def get_queued_gmail_messages(unsent_only: Optional[bool] = True) -> 'pd.DataFrame':
+   # pandas is only needed by this legacy reader, so it isn't loaded until the first call.
+   import pandas as pd
    try:
       with get_postgres_cursor_autocommit('cjremmett') as cursor:
          query = 'select * from ' + GMAIL_OUTGOING_EMAIL_TABLE + ' emails'
@@ -68,27 +215,147 @@ def get_queued_gmail_messages(unsent_only: Optional[bool] = True) -> pd.DataFram
 
 def mark_gmail_emails_sent(message_ids: Iterable[str]) -> None:
    try:
-      update_query = 'update ' + GMAIL_OUTGOING_EMAIL_TABLE + " set sent_timestamp = '" + get_postgres_timestamp_now() + "' WHERE message_id in " + get_sql_formatted_list(message_ids) + ';'
-      execute_postgres_query(update_query)
+      with get_postgres_cursor_autocommit('cjremmett') as cursor:
+         update_query = 'update ' + GMAIL_OUTGOING_EMAIL_TABLE + ' set sent_timestamp = :sent_timestamp where message_id = any(:message_ids)'
+         cursor.execute(sqlalchemy.text(update_query), {'sent_timestamp': get_postgres_timestamp_now(), 'message_ids': list(message_ids)})
+      invalidate_cache_tags([GMAIL_OUTGOING_EMAIL_TABLE])
+      publish_event(OUTBOX_NAMESPACE, 'sent', {'message_ids': list(message_ids)})
    except Exception as e:
       append_to_log('flask_logs', 'EMAIL_TOOLS', 'ERROR', repr(e))
 
 
+def claim_gmail_messages(limit: int, lease_seconds: int = GMAIL_LEASE_SECONDS) -> tuple:
+   """
+   Atomically leases up to limit unsent messages that aren't already leased.
+   SKIP LOCKED lets concurrent pollers claim disjoint sets instead of waiting on each other or double-sending.
+   Returns (lease_id, rows). Raises on failure.
+   """
+   lease_id = get_uuid()
+   claim_query = ('with claimed as ('
+                  ' select message_id from ' + GMAIL_OUTGOING_EMAIL_TABLE +
+                  ' where sent_timestamp is null and (lease_expires is null or lease_expires < now())'
+                  ' order by created_timestamp limit :limit for update skip locked)'
+                  ' update ' + GMAIL_OUTGOING_EMAIL_TABLE + ' emails'
+                  ' set lease_id = :lease_id, lease_expires = now() + make_interval(secs => :lease_seconds)'
+                  ' from claimed where emails.message_id = claimed.message_id'
+                  ' returning emails.message_id, emails.created_timestamp, emails.module, emails.recipient_address, emails.subject, emails.text_body')
+   with get_postgres_cursor_autocommit('cjremmett') as cursor:
+      result = cursor.execute(sqlalchemy.text(claim_query), {'limit': limit, 'lease_id': lease_id, 'lease_seconds': lease_seconds})
+      rows = [dict(row) for row in result.mappings()]
+   if rows:
+      invalidate_cache_tags([GMAIL_OUTGOING_EMAIL_TABLE])
+      publish_event(OUTBOX_NAMESPACE, 'claimed', {'lease_id': lease_id, 'message_ids': [row['message_id'] for row in rows]})
+   return lease_id, rows
+
+
+def ack_gmail_messages(lease_id: str, message_ids: List[str]) -> int:
+   """Marks leased messages sent. Only messages still held by this lease are updated. Returns the number updated."""
+   ack_query = 'update ' + GMAIL_OUTGOING_EMAIL_TABLE + ' set sent_timestamp = :sent_timestamp, lease_expires = null where lease_id = :lease_id and message_id = any(:message_ids) and sent_timestamp is null'
+   with get_postgres_cursor_autocommit('cjremmett') as cursor:
+      acked = cursor.execute(sqlalchemy.text(ack_query), {'sent_timestamp': get_postgres_timestamp_now(), 'lease_id': lease_id, 'message_ids': message_ids}).rowcount
+   if acked:
+      invalidate_cache_tags([GMAIL_OUTGOING_EMAIL_TABLE])
+      publish_event(OUTBOX_NAMESPACE, 'sent', {'lease_id': lease_id, 'message_ids': message_ids})
+   return acked
+
+
+def stream_claimed_gmail_messages(lease_id: str, rows: List[dict]):
+   yield '{"lease_id": ' + json.dumps(lease_id) + ', "messages": ['
+   for i in range(0, len(rows)):
+      yield (',' if i > 0 else '') + json.dumps(rows[i], default=str)
+   yield ']}'
+
+
+def gscript_claim_emails_to_send():
+   """
+   POST endpoint.
+   Leases up to ?limit= unsent messages for ?lease_seconds= and returns them with a lease_id.
+   Send them, then POST the lease_id and sent message_ids to the ack endpoint.
+   """
+   try:
+      if not authorized_via_redis_token(request, 'email_tools'):
+         return ('', 401)
+
+      limit = min(max(request.args.get('limit', GMAIL_CLAIM_DEFAULT_LIMIT, type=int), 1), GMAIL_CLAIM_MAX_LIMIT)
+      lease_seconds = max(request.args.get('lease_seconds', GMAIL_LEASE_SECONDS, type=int), 1)
+      lease_id, rows = claim_gmail_messages(limit, lease_seconds)
+      append_to_log('flask_logs', 'EMAIL_TOOLS', 'TRACE', 'Leased ' + str(len(rows)) + ' outgoing emails under lease ' + lease_id + '.')
+      return Response(stream_claimed_gmail_messages(lease_id, rows), status=200, content_type='application/json')
+   except Exception as e:
+      append_to_log('flask_logs', 'EMAIL_TOOLS', 'ERROR', 'Exception thrown in gscript_claim_emails_to_send: ' + repr(e))
+      return ('', 500)
+
+
+def gscript_ack_sent_emails():
+   """
+   POST endpoint.
+   JSON keys:
+      lease_id
+      message_ids
+   """
+   try:
+      if not authorized_via_redis_token(request, 'email_tools'):
+         return ('', 401)
+
+      json_body = request.json
+      if 'lease_id' not in json_body or 'message_ids' not in json_body or not isinstance(json_body['message_ids'], list):
+         return ('JSON must contain lease_id and a message_ids list.', 400)
+
+      acked = ack_gmail_messages(str(json_body['lease_id']), [str(message_id) for message_id in json_body['message_ids']])
+      return {'acknowledged': acked}
+   except Exception as e:
+      append_to_log('flask_logs', 'EMAIL_TOOLS', 'ERROR', 'Exception thrown in gscript_ack_sent_emails: ' + repr(e))
+      return ('', 500)
+
+
+@cached_response(OUTBOX_CACHE_SECONDS, [GMAIL_OUTGOING_EMAIL_TABLE], 'email_tools')
+def get_outbox_messages():
+   """
+   GET endpoint. Lists outgoing emails without claiming or marking anything, newest first.
+   Query arguments:
+      status: unsent (default), leased or sent
+      limit: max rows
+   """
+   try:
+      if not authorized_via_redis_token(request, 'email_tools'):
+         return ('', 401)
+
+      filters = {'unsent': 'sent_timestamp is null', 'leased': 'sent_timestamp is null and lease_expires > now()', 'sent': 'sent_timestamp is not null'}
+      status = request.args.get('status', 'unsent')
+      if status not in filters:
+         return ('status must be one of ' + ', '.join(filters) + '.', 400)
+      limit = min(max(request.args.get('limit', OUTBOX_QUERY_DEFAULT_LIMIT, type=int), 1), OUTBOX_QUERY_MAX_LIMIT)
+      query = ('select message_id, created_timestamp, module, recipient_address, subject, sent_timestamp, lease_expires from ' + GMAIL_OUTGOING_EMAIL_TABLE +
+               ' where ' + filters[status] + ' order by created_timestamp desc limit :limit')
+      with get_postgres_cursor_autocommit('cjremmett') as cursor:
+         rows = [dict(row) for row in cursor.execute(sqlalchemy.text(query), {'limit': limit}).mappings()]
+      return Response(json.dumps(rows, default=str), status=200, content_type='application/json')
+   except Exception as e:
+      append_to_log('flask_logs', 'EMAIL_TOOLS', 'ERROR', 'Exception thrown in get_outbox_messages: ' + repr(e))
+      return ('', 500)
+
+
 def gscript_get_emails_to_send():
    # Get unsent messages and return them to Gmail for sending.
+   # Claims then acks in one go, so messages leased by claim-outgoing-gscript-emails are never handed out here as well.
    # Could use some improvements, like getting confirmation from Gmail the message was sent before marking it sent.
    try:
       if not authorized_via_redis_token(request, 'email_tools'):
          return ('', 401)
-      
-      df = get_queued_gmail_messages(unsent_only=True)
-      
-      # Mark the messages sent
-      if (len(df) > 0):
-            message_ids = df['message_id'].tolist()
-            mark_gmail_emails_sent(message_ids)
 
-      return Response(df.to_json(orient="records"), status=200, content_type='application/json')
+      lease_id, rows = claim_gmail_messages(GMAIL_CLAIM_MAX_LIMIT)
+      if rows:
+         ack_gmail_messages(lease_id, [row['message_id'] for row in rows])
+
+      return Response(json.dumps(rows, default=str), status=200, content_type='application/json')
 
    except Exception as e:
-      append_to_log('flask_logs', 'EMAIL_TOOLS', 'ERROR', repr(e))
\ No newline at end of file
+      append_to_log('flask_logs', 'EMAIL_TOOLS', 'ERROR', repr(e))
+
+
+if __name__ == '__main__':
+   if ('--deliver' in sys.argv or '-d' in sys.argv) and len(sys.argv) >= 4:
+      # Meant to run from cron as an alternative to the Apps Script poller.
+      print(deliver_queued_messages_via_mailjet(sys.argv[2], sys.argv[3]))
+   else:
+      print('Options:\n--deliver (-d) <from email> <from name> -> Sends queued outgoing emails through Mailjet.')
@@ -1,11 +1,23 @@
 from flask import request, Response
-from utils import append_to_log, get_postgres_cursor_autocommit, get_postgres_date_now, get_uuid, execute_postgres_query, get_sql_formatted_list, authorized_via_redis_token
-from redis_tools import get_secrets_dict
-from email_tools import queue_gmail_message
+from utils import append_to_log, get_postgres_cursor_autocommit, get_postgres_date_now, get_uuid, authorized_via_redis_token, insert_postgres_rows, get_sqlalchemy_query_text, get_postgres_engine, get_postgres_timestamp_now
+from email_tools import queue_gmail_message, GMAIL_OUTGOING_EMAIL_TABLE
+from metrics import dependency_timer
+from circuit_breaker import circuit_breaker, get_http_failures
+from response_cache import cached_response, invalidate_cache_tags
+from live_events import publish_event, CHECKINS_NAMESPACE, OUTBOX_NAMESPACE
+from job_queue import enqueue_job, get_job, register_job_handler, JOB_WORKER_CONCURRENCY
 import requests
+import os
+import threading
+import time
 from typing import List, Optional
 import re
-import pandas as pd
+import email
+import email.policy
+import email.utils
+import html
+import json
+import quopri
 from datetime import datetime
 GAFG_CHECKIN_RECORDS_TABLE = 'gafg_checkin_records'
 GAFG_CHECKIN_USERS_TABLE = 'gafg_checkin_users'
@@ -13,6 +25,46 @@ GAFG_CHECKIN_USERS_TABLE = 'gafg_checkin_users'
 # The user cannot set Saturday or Sunday to true. That's only for debug purposes.
 WEEKDAY_MAP = {0: 'monday', 1: 'tuesday', 2: 'wednesday', 3: 'thursday', 4: 'friday', 5: 'saturday', 6: 'sunday'}
 
+CHECKIN_CREATED = 'created'
+CHECKIN_NO_ACCOUNT = 'no_account'
+CHECKIN_DISABLED = 'disabled'
+CHECKIN_ALREADY_EXISTS = 'already_exists'
+
+IOFFICE_CHECKIN_JOB = 'ioffice_checkin'
+IOFFICE_TIMEOUT_SECONDS = 10
+# Points check-in links at another host, e.g. a local stub server for benchmarks. Unset in production.
+IOFFICE_BASE_URL_OVERRIDE = os.environ.get('IOFFICE_BASE_URL_OVERRIDE')
+IOFFICE_BASE_URL = 'https://gafg.iofficeconnect.com'
+IOFFICE_MAX_ATTEMPTS = 3
+IOFFICE_RETRY_BACKOFF_SECONDS = 2
+
+GAFG_REMINDER_LOCK_NAME = 'gafg_manual_checkin_reminder'
+GAFG_REMINDER_SUBJECT = 'Automatic iOffice Check-In Not Completed'
+GAFG_REMINDER_BODY = "Hello,\n\nPlease be advised that you were not automatically checked in to a seat this morning. Be sure to check in manually if you reserved a seat. If you're unsure why automatic check in failed, please contact Joe for more information.\n\nIf you want to change which days you are automatically checked in, please visit cjremmett.com/ioffice to configure your account.\n\nThanks,\nAutomated Check-In Bot"
+
+# Forwarded check-in emails are a few tens of KB. Anything far bigger isn't one and isn't worth parsing.
+CHECKIN_EMAIL_MAX_CHARS = 2 * 1024 * 1024
+CHECKIN_URL_PATTERN = re.compile(r'https://gafg\.iofficeconnect\.com[^\s"\'<>]*')
+
+GAFG_USER_SETTINGS_COLUMNS = ['monday_checkin', 'tuesday_checkin', 'wednesday_checkin', 'thursday_checkin', 'friday_checkin']
+GAFG_BULK_UPDATE_MAX_USERS = 1000
+
+SAMPLE_STOCKS_CACHE_TAG = 'sample_stocks'
+SAMPLE_CACHE_SECONDS = 300
+RESOURCE_ACCESS_LOGS_CACHE_SECONDS = 10
+
+_ioffice_session = None
+_ioffice_session_pid = None
+_ioffice_session_lock = threading.Lock()
+
+# Check-in dedupe relies on a unique (email_address, record_date) index, so duplicates from before it existed are removed first.
+# The reminder dedupe looks up today's emails per recipient. Apply these with python log_tools.py --schema.
+GAFG_SCHEMA_DDL = [
+    'delete from ' + GAFG_CHECKIN_RECORDS_TABLE + ' a using ' + GAFG_CHECKIN_RECORDS_TABLE + ' b where a.ctid < b.ctid and a.email_address = b.email_address and a.record_date = b.record_date',
+    'create unique index if not exists gafg_checkin_records_email_address_record_date_key on ' + GAFG_CHECKIN_RECORDS_TABLE + ' (email_address, record_date)',
+    'create index if not exists outgoing_emails_recipient_created_idx on ' + GMAIL_OUTGOING_EMAIL_TABLE + ' (recipient_address, created_timestamp)'
+]
+
 
 # Be sure to check for SQL injection in user-provided email addresses because many of the functions in this module do not before constructing the SQL query
 def ioffice_checkin():
@@ -20,6 +72,7 @@ def ioffice_checkin():
     POST endpoint.
     Pass the HTML source of the ioffice checkin email in JSON with the key html_source.
     Pass the from header of the email with the key sender. Expects GAFG email and name format.
+    Returns 202 with a job_id once the check-in is queued. Poll ioffice-checkin-status with it for the result.
     """
     try:
         if not authorized_via_redis_token(request, 'gafg_tools'):
@@ -31,6 +84,9 @@ def ioffice_checkin():
 
         # Get the URL to make the API call to for the checkin.
         url = get_checkin_url(html_source)
+        if url is None:
+            append_to_log('flask_logs', 'GAFG_TOOLS', 'WARNING', 'No iOffice check-in link found in an email of ' + str(len(html_source)) + ' characters. Aborting.')
+            return('', 200)
 
         # Get the sender name and email address
         sender_email = get_sender_email(json_body['sender'])
@@ -43,63 +99,152 @@ def ioffice_checkin():
             append_to_log('flask_logs', 'GAFG_TOOLS', 'WARNING', 'Invalid email and/or sender name received. Aborting. Sender email: ' + sender_email + ' Sender name: ' + sender_name[0] + ' ' + sender_name[1])
             return('', 200)
 
-        # Don't check anyone in unless they have exactly one account
-        user_df = get_checkin_user_df(sender_email)
-        if len(user_df) != 1:
+        # One round trip: exactly one account, enabled for today and not already checked in today.
+        record_date = get_postgres_date_now()
+        checkin_status = claim_checkin_for_today(sender_email, WEEKDAY_MAP[datetime.today().weekday()] + '_checkin', record_date)
+        if checkin_status == CHECKIN_NO_ACCOUNT:
             append_to_log('flask_logs', 'GAFG_TOOLS', 'WARNING', 'Did not check in ' + sender_email + ' because they do not have a GAFG checkin user account or they have multiple accounts.')
             return('', 200)
-        
-        # Don't check them in unless they're configured to auto check in today
-        current_weekday = datetime.today().weekday()
-        if user_df[WEEKDAY_MAP[current_weekday] + '_checkin'][0] != True:
+        elif checkin_status == CHECKIN_DISABLED:
             append_to_log('flask_logs', 'GAFG_TOOLS', 'TRACE', 'Did not check in ' + sender_email + ' because they disabled automatic checkin today.')
             return('', 200)
-
-        # Don't try to check in multiple times in one day
-        if(checkin_record_exists(sender_email)):
+        elif checkin_status == CHECKIN_ALREADY_EXISTS:
             append_to_log('flask_logs', 'GAFG_TOOLS', 'TRACE', 'Did not try to check in ' + sender_email + ' because they were already checked in today.')
             return('', 200)
-        else:
-            create_checkin_record(sender_email)
-
-        # Use a GET request to trigger the checkin
-        response = requests.get(url)
-        append_to_log('flask_logs', 'GAFG_TOOLS', 'TRACE', 'Called ' + url + ' and got status code ' + str(response.status_code) + '.')
-
-        if(response.status_code == 200):
-            queue_gmail_message('GAFG_TOOLS', sender_email, 'Automatic iOffice Check-In Successful', 'Hello ' + sender_name[0] + ' ' + sender_name[1] + ',\n\nYou have been checked into your seat successfully.\n\nIf you no longer want to be checked in automatically, please visit cjremmett.com/ioffice to configure your account.\n\nThanks,\nAutomated Check-In Bot')
-        else:
-            queue_gmail_message('GAFG_TOOLS', sender_email, 'Failed Automatic Check-In', 'Hello ' + sender_name[0] + ' ' + sender_name[1] + ',\n\nAutomated seat check-in failed. Please manually check in. My apologies for any inconvenience.\n\nIf you no longer want to be checked in automatically, please visit cjremmett.com/ioffice to configure your account.\n\nThanks,\nAutomated Check-In Bot')
 
-        return('', 201)
+        # The outbound call runs on a job worker so a slow iOffice response can't stall this worker.
+        try:
+            job_id = enqueue_job(IOFFICE_CHECKIN_JOB, {'url': url, 'sender_email': sender_email, 'sender_name': sender_name})
+        except Exception:
+            # Nothing will check them in without the job, so give back today's claim and let a resent email retry.
+            release_checkin_for_today(sender_email, record_date)
+            raise
+        publish_event(CHECKINS_NAMESPACE, 'checkin_queued', {'job_id': job_id, 'email_address': sender_email})
+        return({'job_id': job_id}, 202)
 
     except Exception as e:
         append_to_log('flask_logs', 'GAFG_TOOLS', 'ERROR', repr(e))
         return ('', 500)
     
 
-def get_checkin_url(html_source: str) -> str:
-    splits = html_source.split('https://gafg.iofficeconnect.com')
-    splits = splits[1].split('" ')
-    url = 'https://gafg.iofficeconnect.com' + splits[0].replace('amp;', '')
-    return url
+def get_ioffice_session() -> requests.Session:
+    # One keep-alive session per process shared by the job worker threads.
+    global _ioffice_session, _ioffice_session_pid
+    if _ioffice_session is not None and _ioffice_session_pid == os.getpid():
+        return _ioffice_session
+    with _ioffice_session_lock:
+        if _ioffice_session is None or _ioffice_session_pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=JOB_WORKER_CONCURRENCY)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _ioffice_session = session
+            _ioffice_session_pid = os.getpid()
+    return _ioffice_session
+
+
+def call_ioffice_checkin_url(url: str) -> int:
+    """GETs the check-in link, retrying connection failures and 5xx responses with backoff. Returns the last status code, or None if every attempt raised."""
+    status_code = None
+    if IOFFICE_BASE_URL_OVERRIDE:
+        url = url.replace(IOFFICE_BASE_URL, IOFFICE_BASE_URL_OVERRIDE, 1)
+    for attempt in range(0, IOFFICE_MAX_ATTEMPTS):
+        try:
+            with circuit_breaker('ioffice', get_http_failures()), dependency_timer('ioffice'):
+                status_code = get_ioffice_session().get(url, timeout=IOFFICE_TIMEOUT_SECONDS).status_code
+            append_to_log('flask_logs', 'GAFG_TOOLS', 'TRACE', 'Called %s and got status code %s.', url, status_code)
+            if status_code < 500:
+                return status_code
+        except Exception as e:
+            append_to_log('flask_logs', 'GAFG_TOOLS', 'WARNING', 'Attempt ' + str(attempt + 1) + ' to call ' + url + ' failed: ' + repr(e))
+        if attempt + 1 < IOFFICE_MAX_ATTEMPTS:
+            time.sleep(IOFFICE_RETRY_BACKOFF_SECONDS * (2 ** attempt))
+    return status_code
+
+
+def run_ioffice_checkin_job(payload: dict) -> dict:
+    sender_email = payload['sender_email']
+    sender_name = payload['sender_name']
+    status_code = call_ioffice_checkin_url(payload['url'])
+    publish_event(CHECKINS_NAMESPACE, 'checkin_completed', {'email_address': sender_email, 'status_code': status_code, 'checked_in': status_code == 200})
+
+    if(status_code == 200):
+        queue_gmail_message('GAFG_TOOLS', sender_email, 'Automatic iOffice Check-In Successful', 'Hello ' + sender_name[0] + ' ' + sender_name[1] + ',\n\nYou have been checked into your seat successfully.\n\nIf you no longer want to be checked in automatically, please visit cjremmett.com/ioffice to configure your account.\n\nThanks,\nAutomated Check-In Bot')
+    else:
+        queue_gmail_message('GAFG_TOOLS', sender_email, 'Failed Automatic Check-In', 'Hello ' + sender_name[0] + ' ' + sender_name[1] + ',\n\nAutomated seat check-in failed. Please manually check in. My apologies for any inconvenience.\n\nIf you no longer want to be checked in automatically, please visit cjremmett.com/ioffice to configure your account.\n\nThanks,\nAutomated Check-In Bot')
+    return {'status_code': status_code}
+
+
+register_job_handler(IOFFICE_CHECKIN_JOB, run_ioffice_checkin_job)
+
+
+def get_ioffice_checkin_status():
+    """
+    GET endpoint.
+    Pass the job_id returned by the check-in endpoint as a query argument.
+    """
+    try:
+        if not authorized_via_redis_token(request, 'gafg_tools'):
+            return('', 401)
+
+        job = get_job(request.args.get('job_id', ''))
+        if job is None or job.get('job_type') != IOFFICE_CHECKIN_JOB:
+            return('No check-in job with that ID exists.', 404)
+        return {'job_id': job['job_id'], 'status': job['status'], 'result': job.get('result'), 'error': job.get('error')}
+    except Exception as e:
+        append_to_log('flask_logs', 'GAFG_TOOLS', 'ERROR', 'Exception thrown in get_ioffice_checkin_status: ' + repr(e))
+        return('', 500)
+
+
+def iter_email_text_parts(raw_email: str):
+    """Yields the decoded text of each HTML or plain-text MIME part, HTML first, decoding quoted-printable and base64 one part at a time."""
+    message = email.message_from_string(raw_email, policy=email.policy.default)
+    parts = [part for part in message.walk() if part.get_content_maintype() == 'text']
+    parts.sort(key=lambda part: 0 if part.get_content_subtype() == 'html' else 1)
+    for part in parts:
+        payload = part.get_payload(decode=True)
+        if payload:
+            yield payload.decode(part.get_content_charset() or 'utf-8', errors='replace')
+
+
+def get_checkin_url(html_source: str) -> Optional[str]:
+    """
+    Returns the first iOffice check-in link in the forwarded email, or None if there isn't one or the email is over CHECKIN_EMAIL_MAX_CHARS.
+    Accepts a full RFC 5322 message or just the HTML body.
+    """
+    if html_source is None or len(html_source) > CHECKIN_EMAIL_MAX_CHARS:
+        return None
+    try:
+        for text in iter_email_text_parts(html_source):
+            match = CHECKIN_URL_PATTERN.search(text)
+            if match:
+                return html.unescape(match.group(0))
+    except Exception as e:
+        append_to_log('flask_logs', 'GAFG_TOOLS', 'WARNING', 'Failed to parse MIME parts of check-in email, scanning raw source instead: ' + repr(e))
+    # Not a MIME message, or the link is outside any part. A raw quoted-printable body writes '=' as '=3D', so decode it first.
+    # Anything else only gets soft line breaks removed, since decoding would turn a plain '?id=12' into a control character.
+    if '=3D' in html_source:
+        html_source = quopri.decodestring(html_source.encode('utf-8', errors='replace')).decode('utf-8', errors='replace')
+    else:
+        html_source = html_source.replace('=\r\n', '').replace('=\n', '')
+    match = CHECKIN_URL_PATTERN.search(html_source)
+    return html.unescape(match.group(0)) if match else None
 
 
 def get_sender_email(sender: str) -> str:
     # Input format: "Remmett, Christopher" <christopher.remmett@gmail.com>
-    splits = sender.split('<')
-    return splits[1][:-1]
+    return email.utils.parseaddr(sender)[1]
 
 
 def get_sender_name(sender: str) -> List[str]:
     # Input format: "Remmett, Christopher" <christopher.remmett@gmail.com>
-    splits = sender.split(',')
-    last_name = splits[0][1:]
-
-    splits = splits[1].split('"')
-    first_name = splits[0][1:]
-
-    return [first_name, last_name]
+    # Also accepts "Christopher Remmett" <...>. Returns [first_name, last_name], with empty strings for anything missing.
+    name = email.utils.parseaddr(sender)[0].strip()
+    if ',' in name:
+        last_name, first_name = name.split(',', 1)
+    else:
+        first_name, _, last_name = name.rpartition(' ')
+    return [first_name.strip(), last_name.strip()]
 
 
 def check_if_request_valid(sender_email: str, sender_name: List[str]) -> bool:
@@ -125,58 +270,63 @@ def check_if_sender_name_valid(sender_name: str) -> bool:
         return True
     
 
-def create_checkin_record(email_address: str, record_date: Optional[str] = None) -> bool:
-    try:
-        if record_date == None:
-            record_date = get_postgres_date_now()
-        with get_postgres_cursor_autocommit('cjremmett') as cursor:
-            record = pd.DataFrame({
-                'email_address': [email_address],
-                'record_date': [record_date]
-            })
-            record.to_sql(name=GAFG_CHECKIN_RECORDS_TABLE, con=cursor, if_exists='append', index=False)
-        return True
-    except Exception as e:
-        append_to_log('flask_logs', 'GAFG_TOOLS', 'ERROR', repr(e))
-        return False
+def claim_checkin_for_today(email_address: str, weekday_column: str, record_date: Optional[str] = None) -> str:
+    """
+    Looks up the user, checks whether they check in on this weekday and inserts today's record in one statement.
+    The unique (email_address, record_date) key makes concurrent duplicates a no-op instead of a race.
+    Returns one of CHECKIN_CREATED, CHECKIN_NO_ACCOUNT, CHECKIN_DISABLED or CHECKIN_ALREADY_EXISTS. Raises on failure.
+    """
+    if record_date == None:
+        record_date = get_postgres_date_now()
+    # weekday_column comes from WEEKDAY_MAP, never from the request.
+    query = ('with user_row as ('
+             ' select count(*) as accounts, coalesce(bool_and(users.' + weekday_column + '), false) as enabled'
+             ' from ' + GAFG_CHECKIN_USERS_TABLE + ' users where users.email_address = :email_address),'
+             ' inserted as ('
+             ' insert into ' + GAFG_CHECKIN_RECORDS_TABLE + ' (email_address, record_date)'
+             ' select :email_address, cast(:record_date as date) from user_row where user_row.accounts = 1 and user_row.enabled'
+             ' on conflict (email_address, record_date) do nothing'
+             ' returning 1)'
+             ' select user_row.accounts, user_row.enabled, (select count(*) from inserted) as inserted from user_row')
+    with get_postgres_cursor_autocommit('cjremmett') as cursor:
+        row = cursor.execute(get_sqlalchemy_query_text(query), {'email_address': email_address, 'record_date': record_date}).one()
+    if row.accounts != 1:
+        return CHECKIN_NO_ACCOUNT
+    elif not row.enabled:
+        return CHECKIN_DISABLED
+    elif row.inserted == 0:
+        return CHECKIN_ALREADY_EXISTS
+    else:
+        return CHECKIN_CREATED
 
 
-def checkin_record_exists(email_address: str, record_date: Optional[str] = None) -> bool:
-    try:
-        if record_date == None:
-            record_date = get_postgres_date_now()
-        with get_postgres_cursor_autocommit('cjremmett') as cursor:
-            query = 'select count(*) from ' + GAFG_CHECKIN_RECORDS_TABLE + " records where records.record_date = '" + record_date + "' and records.email_address = '" + email_address + "'"
-            append_to_log('flask_logs', 'GAFG_TOOLS', 'DEBUG', 'GAFG checkin exists query: ' + query)
-            df = pd.read_sql_query(query, con=cursor)
-            append_to_log('flask_logs', 'GAFG_TOOLS', 'DEBUG', 'GAFG checkin results df: ' + str(df))
-            count = int(df['count'][0])
-            return True if count > 0 else False
-    except Exception as e:
-        append_to_log('flask_logs', 'GAFG_TOOLS', 'ERROR', repr(e))
-        return True
-    
+def release_checkin_for_today(email_address: str, record_date: str) -> None:
+    """
+    Deletes the record claim_checkin_for_today inserted, for when the check-in could not be queued.
+    """
+    query = 'delete from ' + GAFG_CHECKIN_RECORDS_TABLE + ' where email_address = :email_address and record_date = cast(:record_date as date)'
+    with get_postgres_cursor_autocommit('cjremmett') as cursor:
+        cursor.execute(get_sqlalchemy_query_text(query), {'email_address': email_address, 'record_date': record_date})
+
 
 def create_checkin_user(email_address: str) -> bool:
     try:
-        existing_user_df = get_checkin_user_df(email_address)
-        if len(existing_user_df) > 0:
+        if len(get_checkin_user_rows(email_address)) > 0:
             append_to_log('flask_logs', 'GAFG_TOOLS', 'WARNING', 'User with email address ' + email_address + ' already exists. Aborting.')
             return False
         uuid = get_uuid()
-        with get_postgres_cursor_autocommit('cjremmett') as cursor:
-            user = pd.DataFrame({
-                'email_address': [email_address],
-                'secret_key': [uuid],
-                'monday_checkin': [True],
-                'tuesday_checkin': [True],
-                'wednesday_checkin': [True],
-                'thursday_checkin': [True],
-                'friday_checkin': [False],
-                'saturday_checkin': [False],
-                'sunday_checkin': [False]
-            })
-            user.to_sql(name=GAFG_CHECKIN_USERS_TABLE, con=cursor, if_exists='append', index=False)
+        user = {
+            'email_address': email_address,
+            'secret_key': uuid,
+            'monday_checkin': True,
+            'tuesday_checkin': True,
+            'wednesday_checkin': True,
+            'thursday_checkin': True,
+            'friday_checkin': False,
+            'saturday_checkin': False,
+            'sunday_checkin': False
+        }
+        insert_postgres_rows(GAFG_CHECKIN_USERS_TABLE, user)
         queue_gmail_message('GAFG_TOOLS', email_address, 'Automatic iOffice Check-In Account Created', 'Hello,\n\nYour automatic iOffice check-in acount has been created! To use this tool, please create an outlook rule to forward your iOffice check-in emails to cjriofficecheckinbot@gmail.com.\n\nPlease visit cjremmett.com/ioffice to configure which days you want to be checked in automatically. Your secret key is ' + uuid + ". Remember, don't share or lose this key! If you do, you'll have to come crawling to Joe and beg for a new one.\n\nThanks,\nAutomated Check-In Bot")
         append_to_log('flask_logs', 'GAFG_TOOLS', 'TRACE', 'Created new GAFG checkin user with email address ' + email_address + '.')
         return True
@@ -185,23 +335,53 @@ def create_checkin_user(email_address: str) -> bool:
         return False
     
 
-def get_checkin_user_df(email_address: str) -> bool:
-    try:
-      with get_postgres_cursor_autocommit('cjremmett') as cursor:
-         query = 'select gciu.* from ' + GAFG_CHECKIN_USERS_TABLE + " gciu where gciu.email_address = '" + email_address + "'"
-         df = pd.read_sql_query(query, con=cursor)
-         return df
-    except Exception as e:
-      append_to_log('flask_logs', 'GAFG_TOOLS', 'ERROR', repr(e))
+def get_checkin_user_rows(email_address: str) -> List[dict]:
+    with get_postgres_cursor_autocommit('cjremmett') as cursor:
+        query = 'select gciu.* from ' + GAFG_CHECKIN_USERS_TABLE + ' gciu where gciu.email_address = :email_address'
+        return [dict(row) for row in cursor.execute(get_sqlalchemy_query_text(query), {'email_address': email_address}).mappings()]
+
+
+def checkin_user_secret_key_matches(email_address: str, secret_key: str) -> bool:
+    """
+    Returns True if exactly one account has this email address and its secret key matches.
+    """
+    query = ('select count(*) as accounts, count(*) filter (where cast(users.secret_key as text) = :secret_key) as matches'
+             ' from ' + GAFG_CHECKIN_USERS_TABLE + ' users where users.email_address = :email_address')
+    with get_postgres_cursor_autocommit('cjremmett') as cursor:
+        row = cursor.execute(get_sqlalchemy_query_text(query), {'email_address': email_address, 'secret_key': str(secret_key)}).one()
+    return row.accounts == 1 and row.matches == 1
+
+
+def update_checkin_user_settings_bulk(settings: List[dict]) -> List[dict]:
+    """
+    Applies many users' weekday settings in one UPDATE ... FROM (VALUES ...).
+    Each dict needs email_address. Weekday keys that are missing or None leave that setting unchanged.
+    Returns the updated rows. Raises on failure.
+    """
+    if not settings:
+        return []
+    values = []
+    params = {}
+    for i in range(0, len(settings)):
+        row_params = ['cast(:email_address_' + str(i) + ' as text)']
+        params['email_address_' + str(i)] = settings[i]['email_address']
+        for column in GAFG_USER_SETTINGS_COLUMNS:
+            row_params.append('cast(:' + column + '_' + str(i) + ' as boolean)')
+            params[column + '_' + str(i)] = settings[i].get(column)
+        values.append('(' + ', '.join(row_params) + ')')
+    query = ('update ' + GAFG_CHECKIN_USERS_TABLE + ' users set '
+             + ', '.join(column + ' = coalesce(new_settings.' + column + ', users.' + column + ')' for column in GAFG_USER_SETTINGS_COLUMNS)
+             + ' from (values ' + ', '.join(values) + ') as new_settings (email_address, ' + ', '.join(GAFG_USER_SETTINGS_COLUMNS) + ')'
+             + ' where users.email_address = new_settings.email_address returning users.*')
+    with get_postgres_cursor_autocommit('cjremmett') as cursor:
+        return [dict(row) for row in cursor.execute(get_sqlalchemy_query_text(query), params).mappings()]
 
 
 def update_gafg_checkin_user_weekday_settings(email_address: str, monday_checkin: Optional[bool] = None, tuesday_checkin: Optional[bool] = None, wednesday_checkin: Optional[bool] = None, thursday_checkin: Optional[bool] = None, friday_checkin: Optional[bool] = None) -> bool:
     # Don't call this until the email address has been checked for SQL injections, the user account exists and secret key auth passed
     try:
-        user_df = get_checkin_user_df(email_address)
-        update_query = 'update ' + GAFG_CHECKIN_USERS_TABLE + " set monday_checkin = '" + str(monday_checkin if monday_checkin != None else user_df['monday_checkin']) + "', tuesday_checkin = '" + str(tuesday_checkin if tuesday_checkin != None else user_df['tuesday_checkin']) + "', wednesday_checkin = '" + str(wednesday_checkin if wednesday_checkin != None else user_df['wednesday_checkin']) + "', thursday_checkin = '" + str(thursday_checkin if thursday_checkin != None else user_df['thursday_checkin']) + "', friday_checkin = '" + str(friday_checkin if friday_checkin != None else user_df['friday_checkin']) + "' where email_address = '" + email_address + "';"
-        append_to_log('flask_logs', 'EMAIL_TOOLS', 'TRACE', update_query)
-        execute_postgres_query(update_query)
+        update_checkin_user_settings_bulk([{'email_address': email_address, 'monday_checkin': monday_checkin, 'tuesday_checkin': tuesday_checkin, 'wednesday_checkin': wednesday_checkin, 'thursday_checkin': thursday_checkin, 'friday_checkin': friday_checkin}])
+        append_to_log('flask_logs', 'GAFG_TOOLS', 'TRACE', 'Updated weekday settings for ' + email_address + '.')
         return True
     except Exception as e:
         append_to_log('flask_logs', 'GAFG_TOOLS', 'ERROR', repr(e))
@@ -241,8 +421,7 @@ def update_gafg_checkin_user_account():
                     json_body[WEEKDAY_MAP[key] + '_checkin'] = True if json_value == 'True' else False
         
         # Check if the account exists and if the secret key matches
-        user_df = get_checkin_user_df(json_body['email_address'])
-        if len(user_df) != 1 or json_body['secret_key'] != user_df['secret_key'][0]:
+        if not checkin_user_secret_key_matches(json_body['email_address'], json_body['secret_key']):
             return('Authentication failed. Either no account with that email address exists or you entered the wrong secret key.', 400)
         
         update_gafg_checkin_user_weekday_settings(email_address=str(json_body['email_address']), monday_checkin=json_body['monday_checkin'], tuesday_checkin=json_body['tuesday_checkin'], wednesday_checkin=json_body['wednesday_checkin'], thursday_checkin=json_body['thursday_checkin'], friday_checkin=json_body['friday_checkin'])
@@ -252,6 +431,64 @@ def update_gafg_checkin_user_account():
       return('', 500)
 
 
+def queue_manual_checkin_reminders(weekday_column: str, record_date: Optional[str] = None) -> int:
+    """
+    Queues the manual check-in reminder for every user enabled on this weekday who has no check-in record today, in one INSERT ... SELECT.
+    Users who already got today's reminder are skipped, and an advisory lock serializes concurrent triggers, so re-triggering never double-queues.
+    Returns the number of reminders queued. Raises on failure.
+    """
+    if record_date == None:
+        record_date = get_postgres_date_now()
+    # weekday_column comes from WEEKDAY_MAP, never from the request.
+    query = ('insert into ' + GMAIL_OUTGOING_EMAIL_TABLE + ' (created_timestamp, module, recipient_address, subject, text_body, message_id)'
+             ' select cast(:created_timestamp as timestamp), :module, users.email_address, :subject, :body, gen_random_uuid()::text'
+             ' from ' + GAFG_CHECKIN_USERS_TABLE + ' users'
+             ' where users.' + weekday_column + ' = True'
+             ' and not exists (select 1 from ' + GAFG_CHECKIN_RECORDS_TABLE + ' records where records.email_address = users.email_address and records.record_date = cast(:record_date as date))'
+             ' and not exists (select 1 from ' + GMAIL_OUTGOING_EMAIL_TABLE + ' emails where emails.recipient_address = users.email_address and emails.module = :module and emails.subject = :subject and emails.created_timestamp >= cast(:record_date as timestamp))')
+    with get_postgres_engine('cjremmett').begin() as connection:
+        connection.execute(get_sqlalchemy_query_text("select pg_advisory_xact_lock(hashtext('" + GAFG_REMINDER_LOCK_NAME + "'))"))
+        result = connection.execute(get_sqlalchemy_query_text(query), {'created_timestamp': get_postgres_timestamp_now(), 'module': 'GAFG_TOOLS', 'subject': GAFG_REMINDER_SUBJECT, 'body': GAFG_REMINDER_BODY, 'record_date': record_date})
+        queued = result.rowcount
+    invalidate_cache_tags([GMAIL_OUTGOING_EMAIL_TABLE])
+    if queued:
+        publish_event(OUTBOX_NAMESPACE, 'queued', {'module': 'GAFG_TOOLS', 'count': queued})
+    return queued
+
+
+def update_gafg_checkin_users_bulk():
+    """Admin endpoint to change many users' weekday settings at once. Requires the gafg_tools token.
+
+    JSON keys:
+        users: list of objects with email_address and any of monday_checkin ... friday_checkin ('True'/'False' or booleans)
+    """
+    try:
+        if not authorized_via_redis_token(request, 'gafg_tools'):
+            return('', 401)
+
+        json_body = request.json
+        if 'users' not in json_body or not isinstance(json_body['users'], list) or len(json_body['users']) > GAFG_BULK_UPDATE_MAX_USERS:
+            return('JSON must contain a users list of at most ' + str(GAFG_BULK_UPDATE_MAX_USERS) + ' entries.', 400)
+
+        settings = []
+        for user in json_body['users']:
+            if not isinstance(user, dict) or not check_if_email_valid(user.get('email_address')):
+                return('Only valid GAFG email addresses are accepted.', 400)
+            user_settings = {'email_address': user['email_address']}
+            for column in GAFG_USER_SETTINGS_COLUMNS:
+                value = user.get(column)
+                if value not in (None, True, False, 'True', 'False'):
+                    return("Please enter either 'True' or 'False' for the weekday checkin JSON keys.", 400)
+                user_settings[column] = value if value in (None, True, False) else value == 'True'
+            settings.append(user_settings)
+
+        updated = update_checkin_user_settings_bulk(settings)
+        return {'updated': len(updated)}
+    except Exception as e:
+        append_to_log('flask_logs', 'GAFG_TOOLS', 'ERROR', 'Exception thrown in update_gafg_checkin_users_bulk: ' + repr(e))
+        return('', 500)
+
+
 def trigger_manual_checkin_reminder():
     """Call this endpoint to send a manual checkin reminder email to all users who were not automatically checked in today."""
     try:
@@ -260,40 +497,29 @@ def trigger_manual_checkin_reminder():
         
         current_weekday_integer = datetime.today().weekday()
         current_weekday_column = WEEKDAY_MAP[current_weekday_integer] + '_checkin'
-        with get_postgres_cursor_autocommit('cjremmett') as cursor:
-            # Get email addresses that were already checked in today
-            record_date = get_postgres_date_now()
-            query = 'select records.email_address from ' + GAFG_CHECKIN_RECORDS_TABLE + " records where records.record_date = '" + record_date + "'"
-            append_to_log('flask_logs', 'GAFG_TOOLS', 'DEBUG', 'GAFG manual notification records query: ' + query)
-            records_df = pd.read_sql_query(query, con=cursor)
-            append_to_log('flask_logs', 'GAFG_TOOLS', 'DEBUG', 'GAFG manual notification records df: ' + str(records_df))
-
-            # Get users who are in not list of users already checked in today
-            query = 'select users.email_address from ' + GAFG_CHECKIN_USERS_TABLE + " users where users." + current_weekday_column + " = True and users.email_address not in " + get_sql_formatted_list(records_df['email_address'].tolist())
-            append_to_log('flask_logs', 'GAFG_TOOLS', 'DEBUG', 'GAFG manual notification query: ' + query)
-            user_df = pd.read_sql_query(query, con=cursor)
-            append_to_log('flask_logs', 'GAFG_TOOLS', 'DEBUG', 'GAFG manual notification results df: ' + str(user_df))
-
-        for i in range(0, len(user_df)):
-            queue_gmail_message('GAFG_TOOLS', user_df['email_address'][i], 'Automatic iOffice Check-In Not Completed', "Hello,\n\nPlease be advised that you were not automatically checked in to a seat this morning. Be sure to check in manually if you reserved a seat. If you're unsure why automatic check in failed, please contact Joe for more information.\n\nIf you want to change which days you are automatically checked in, please visit cjremmett.com/ioffice to configure your account.\n\nThanks,\nAutomated Check-In Bot")
+        queued = queue_manual_checkin_reminders(current_weekday_column)
+        append_to_log('flask_logs', 'GAFG_TOOLS', 'TRACE', 'Queued %s manual checkin reminder emails.', queued)
         return ('', 201)
     except Exception as e:
       append_to_log('flask_logs', 'GAFG_TOOLS', 'ERROR', 'Exception thrown in trigger_manual_checkin_reminder: ' + repr(e))
       return('', 500)
     
 
+
+@cached_response(RESOURCE_ACCESS_LOGS_CACHE_SECONDS, ['resource_access_logs'])
 def get_resource_access_logs():
     try:
         return ('Disabled, contact Joe to enable this.', 401)
         with get_postgres_cursor_autocommit('cjremmett') as cursor:
             query = 'select * from resource_access_logs order by timestamp desc limit 20'
-            records_df = pd.read_sql_query(query, con=cursor)
-            return Response(records_df.to_json(orient="records"), mimetype='application/json')
+            rows = cursor.execute(get_sqlalchemy_query_text(query)).mappings().all()
+            return Response(json.dumps([dict(row) for row in rows], default=str), mimetype='application/json')
     except Exception as e:
         append_to_log('flask_logs', 'GAFG_TOOLS', 'ERROR', 'Exception thrown in get_resource_access_logs: ' + repr(e))
         return('', 500)
     
 
+@cached_response(SAMPLE_CACHE_SECONDS, [SAMPLE_STOCKS_CACHE_TAG])
 def get_sample_data():
     # Example output:
     #     {
@@ -326,10 +552,12 @@ def submit_sample_stock():
         if 'Ticker' in json_body and 'Price' in json_body:
             if  (json_body['Ticker'] == 'AAPL' or json_body['Ticker'] == 'MSFT' or json_body['Ticker'] == 'AMZN'):
                 append_to_log('flask_logs', 'GAFG_TOOLS', 'TRACE', 'Successfully received API call with ticker ' + json_body['Ticker'] + '.')
+                invalidate_cache_tags([SAMPLE_STOCKS_CACHE_TAG])
                 return('Processed OK!', 201)
         elif 'ticker' in json_body and 'price' in json_body:
             if (json_body['ticker'] == 'AAPL' or json_body['ticker'] == 'MSFT' or json_body['ticker'] == 'AMZN'):
                 append_to_log('flask_logs', 'GAFG_TOOLS', 'TRACE', 'Successfully received API call with ticker ' + json_body['ticker'] + '.')
+                invalidate_cache_tags([SAMPLE_STOCKS_CACHE_TAG])
                 return('Processed OK!', 201)
         else:
             append_to_log('flask_logs', 'GAFG_TOOLS', 'WARNING', 'Failed to find required fields in submit_sample_stock. Received: ' + str(json_body))
@@ -339,6 +567,7 @@ def submit_sample_stock():
         return('', 500)
 
 
+@cached_response(SAMPLE_CACHE_SECONDS, [SAMPLE_STOCKS_CACHE_TAG])
 def get_sample_portfolio():
     # Total sum in $86,550
     try:
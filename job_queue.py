@@ -0,0 +1,194 @@
+from redis_tools import get_redis_cursor, REDIS_HOST
+from utils import append_to_log, get_uuid, get_postgres_timestamp_now
+from typing import Callable, Optional
+import importlib
+import json
+import os
+import queue
+import threading
+import time
+# Jobs are queued in Redis so any worker can run them. If Redis is unreachable they run in the process that queued them.
+# A claimed job sits on the processing list until its worker finishes it. If the worker dies first the job is requeued
+# once its lease expires, so a job can run more than once but is never lost.
+JOB_QUEUE_KEY = 'jobs:queue'
+JOB_PROCESSING_KEY = 'jobs:processing'
+JOB_KEY_PREFIX = 'jobs:'
+JOB_TTL_SECONDS = 86400
+JOB_WORKER_CONCURRENCY = 4
+JOB_POLL_SECONDS = 1
+JOB_LEASE_SECONDS = 300
+JOB_REAP_INTERVAL_SECONDS = 30
+
+# Only requeue if the job is still on the processing list, so two reapers can't both requeue it. A job that already finished
+# only lost its ack, so it is dropped from the list instead of being run again.
+REQUEUE_EXPIRED_JOB_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 1 then
+    local status = redis.call('HGET', KEYS[3], 'status')
+    if status == ARGV[3] or status == ARGV[4] then
+        return 0
+    end
+    redis.call('HSET', KEYS[3], 'status', ARGV[2])
+    redis.call('HDEL', KEYS[3], 'lease_expires')
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+_job_handlers = {}
+_job_handler_modules = {}
+_local_job_queue = queue.Queue()
+_local_jobs = {}
+_job_workers_pid = None
+_job_workers_lock = threading.Lock()
+
+
+def register_job_handler(job_type: str, handler: Callable[[dict], Optional[dict]]) -> None:
+    """Handlers take the job payload and return a JSON-serializable result. Raising marks the job failed."""
+    _job_handlers[job_type] = handler
+
+
+def register_job_module(job_type: str, module: str) -> None:
+    """Names the module that registers job_type's handler, so workers can run the job before anything else has imported it."""
+    _job_handler_modules[job_type] = module
+
+
+def get_job_handler(job_type: str) -> Callable[[dict], Optional[dict]]:
+    if job_type not in _job_handlers and job_type in _job_handler_modules:
+        importlib.import_module(_job_handler_modules[job_type])
+    return _job_handlers[job_type]
+
+
+def save_job(job_id: str, fields: dict) -> None:
+    fields['updated'] = get_postgres_timestamp_now()
+    if job_id in _local_jobs:
+        _local_jobs[job_id].update(fields)
+        return
+    r = get_redis_cursor(host=REDIS_HOST)
+    pipe = r.pipeline()
+    pipe.hset(JOB_KEY_PREFIX + job_id, mapping={key: json.dumps(value) for key, value in fields.items()})
+    pipe.expire(JOB_KEY_PREFIX + job_id, JOB_TTL_SECONDS)
+    pipe.execute()
+
+
+def enqueue_job(job_type: str, payload: dict) -> str:
+    start_job_workers()
+    job_id = get_uuid()
+    job = {'job_id': job_id, 'job_type': job_type, 'payload': payload, 'status': JOB_QUEUED, 'created': get_postgres_timestamp_now()}
+    try:
+        r = get_redis_cursor(host=REDIS_HOST)
+        pipe = r.pipeline(transaction=True)
+        pipe.hset(JOB_KEY_PREFIX + job_id, mapping={key: json.dumps(value) for key, value in job.items()})
+        pipe.expire(JOB_KEY_PREFIX + job_id, JOB_TTL_SECONDS)
+        pipe.lpush(JOB_QUEUE_KEY, job_id)
+        pipe.execute()
+    except Exception as e:
+        append_to_log('flask_logs', 'JOB_QUEUE', 'WARNING', 'Redis unavailable, running job ' + job_id + ' in process. Error: ' + repr(e))
+        _local_jobs[job_id] = job
+        _local_job_queue.put(job_id)
+    return job_id
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    start_job_workers()
+    if job_id in _local_jobs:
+        return dict(_local_jobs[job_id])
+    r = get_redis_cursor(host=REDIS_HOST)
+    fields = r.hgetall(JOB_KEY_PREFIX + job_id)
+    if not fields:
+        return None
+    return {key: json.loads(value) for key, value in fields.items()}
+
+
+def run_job(job_id: str) -> None:
+    job = get_job(job_id)
+    if job is None:
+        return
+    try:
+        save_job(job_id, {'status': JOB_RUNNING})
+        result = get_job_handler(job['job_type'])(job['payload'])
+        save_job(job_id, {'status': JOB_SUCCEEDED, 'result': result})
+    except Exception as e:
+        append_to_log('flask_logs', 'JOB_QUEUE', 'ERROR', 'Job ' + job_id + ' of type ' + str(job.get('job_type')) + ' failed: ' + repr(e))
+        save_job(job_id, {'status': JOB_FAILED, 'error': repr(e)})
+
+
+def get_next_job_id() -> Optional[str]:
+    try:
+        return _local_job_queue.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        r = get_redis_cursor(host=REDIS_HOST)
+        job_id = r.blmove(JOB_QUEUE_KEY, JOB_PROCESSING_KEY, JOB_POLL_SECONDS, 'RIGHT', 'LEFT')
+        if job_id:
+            r.hset(JOB_KEY_PREFIX + job_id, 'lease_expires', json.dumps(time.time() + JOB_LEASE_SECONDS))
+        return job_id
+    except Exception:
+        # Redis is down, so only local jobs can arrive.
+        try:
+            return _local_job_queue.get(timeout=JOB_POLL_SECONDS)
+        except queue.Empty:
+            return None
+
+
+def ack_job(job_id: str) -> None:
+    # Local jobs only live in this process, so they are forgotten once done.
+    if job_id in _local_jobs:
+        del _local_jobs[job_id]
+        return
+    get_redis_cursor(host=REDIS_HOST).lrem(JOB_PROCESSING_KEY, 1, job_id)
+
+
+def requeue_expired_jobs() -> None:
+    r = get_redis_cursor(host=REDIS_HOST)
+    now = time.time()
+    for job_id in r.lrange(JOB_PROCESSING_KEY, 0, -1):
+        job_key = JOB_KEY_PREFIX + job_id
+        lease_expires = r.hget(job_key, 'lease_expires')
+        if lease_expires is None:
+            if r.exists(job_key):
+                # The worker died between claiming the job and stamping its lease, so start the clock now.
+                r.hsetnx(job_key, 'lease_expires', json.dumps(now + JOB_LEASE_SECONDS))
+            else:
+                # The job expired, there is nothing left to run.
+                r.lrem(JOB_PROCESSING_KEY, 1, job_id)
+        elif json.loads(lease_expires) < now:
+            if r.eval(REQUEUE_EXPIRED_JOB_SCRIPT, 3, JOB_PROCESSING_KEY, JOB_QUEUE_KEY, job_key, job_id, json.dumps(JOB_QUEUED), json.dumps(JOB_SUCCEEDED), json.dumps(JOB_FAILED)):
+                append_to_log('flask_logs', 'JOB_QUEUE', 'WARNING', 'Lease on job ' + job_id + ' expired, requeued it.')
+
+
+def job_worker_loop(reap_expired: bool = False) -> None:
+    next_reap = 0
+    while True:
+        try:
+            if reap_expired and time.time() >= next_reap:
+                next_reap = time.time() + JOB_REAP_INTERVAL_SECONDS
+                requeue_expired_jobs()
+            job_id = get_next_job_id()
+            if job_id:
+                try:
+                    run_job(job_id)
+                finally:
+                    ack_job(job_id)
+        except Exception as e:
+            append_to_log('flask_logs', 'JOB_QUEUE', 'ERROR', 'Exception thrown in job worker: ' + repr(e))
+            time.sleep(JOB_POLL_SECONDS)
+
+
+def start_job_workers() -> None:
+    # Threads don't survive fork, so each gunicorn worker starts its own pool the first time it queues or looks up a job.
+    # JOB_WORKER_CONCURRENCY bounds concurrent jobs per process.
+    global _job_workers_pid
+    if _job_workers_pid == os.getpid():
+        return
+    with _job_workers_lock:
+        if _job_workers_pid != os.getpid():
+            for i in range(0, JOB_WORKER_CONCURRENCY):
+                threading.Thread(target=job_worker_loop, args=(i == 0,), name='job-worker-' + str(i), daemon=True).start()
+            _job_workers_pid = os.getpid()
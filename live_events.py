@@ -0,0 +1,123 @@
+from flask import request
+from redis_tools import get_redis_cursor, get_secrets_dict, REDIS_HOST, REDIS_PORT
+from typing import Optional
+import json
+import os
+import threading
+import time
+# Live events replace polling in the web UI. Any process publishes to one Redis channel, and each worker relays the
+# events to the SocketIO clients connected to it. SocketIO itself uses Redis as its message queue so emits reach every worker.
+# Clients must ack each event. A client with LIVE_MAX_IN_FLIGHT unacked events is skipped instead of buffering without bound,
+# and once it catches up it gets one 'resync' event with the number it missed so it can refetch over REST.
+LIVE_EVENTS_CHANNEL = 'live_events'
+LIVE_MAX_IN_FLIGHT = 50
+LIVE_RELAY_RETRY_SECONDS = 5
+
+# Namespace -> the module whose API token clients must pass, as auth={'token': ...} or a token header.
+LIVE_NAMESPACES = {
+    '/live/checkins': 'gafg_tools',
+    '/live/outbox': 'email_tools',
+    '/live/access-logs': 'log_tools'
+}
+CHECKINS_NAMESPACE = '/live/checkins'
+OUTBOX_NAMESPACE = '/live/outbox'
+ACCESS_LOGS_NAMESPACE = '/live/access-logs'
+
+_socketio = None
+_clients = {namespace: {} for namespace in LIVE_NAMESPACES}
+_clients_lock = threading.Lock()
+_relay_pid = None
+_relay_lock = threading.Lock()
+
+
+def get_message_queue_url() -> str:
+    return 'redis://' + REDIS_HOST + ':' + str(REDIS_PORT)
+
+
+def publish_event(namespace: str, event: str, data) -> None:
+    # Never raises. Live events are best effort and must not fail the write that produced them.
+    try:
+        get_redis_cursor(host=REDIS_HOST).publish(LIVE_EVENTS_CHANNEL, json.dumps({'namespace': namespace, 'event': event, 'data': data}, default=str))
+    except Exception as e:
+        print('Failed to publish live event ' + namespace + ' ' + event + '. Error:' + repr(e))
+
+
+def acknowledge(namespace: str, sid: str) -> None:
+    resync = 0
+    with _clients_lock:
+        client = _clients[namespace].get(sid)
+        if client is None:
+            return
+        client['in_flight'] = max(client['in_flight'] - 1, 0)
+        if client['dropped'] and client['in_flight'] == 0:
+            resync, client['dropped'] = client['dropped'], 0
+            client['in_flight'] = 1
+    if resync:
+        _socketio.emit('resync', {'dropped': resync}, namespace=namespace, to=sid, callback=lambda *args: acknowledge(namespace, sid))
+
+
+def deliver_event(namespace: str, event: str, data) -> None:
+    if namespace not in _clients:
+        return
+    with _clients_lock:
+        ready = []
+        for sid, client in _clients[namespace].items():
+            if client['in_flight'] >= LIVE_MAX_IN_FLIGHT or client['dropped']:
+                client['dropped'] += 1
+            else:
+                client['in_flight'] += 1
+                ready.append(sid)
+    for sid in ready:
+        _socketio.emit(event, data, namespace=namespace, to=sid, callback=lambda *args, sid=sid: acknowledge(namespace, sid))
+
+
+def _relay_live_events():
+    while True:
+        try:
+            pubsub = get_redis_cursor(host=REDIS_HOST, socket_timeout=None).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(LIVE_EVENTS_CHANNEL)
+            for message in pubsub.listen():
+                event = json.loads(message['data'])
+                deliver_event(event['namespace'], event['event'], event['data'])
+        except Exception as e:
+            print('Live event relay disconnected. Error:' + repr(e))
+            time.sleep(LIVE_RELAY_RETRY_SECONDS)
+
+
+def _ensure_relay_running():
+    # Threads don't survive fork, so each worker subscribes when its first client connects.
+    global _relay_pid
+    if _relay_pid == os.getpid():
+        return
+    with _relay_lock:
+        if _relay_pid != os.getpid():
+            _socketio.start_background_task(_relay_live_events)
+            _relay_pid = os.getpid()
+
+
+def is_authorized(module: str, auth: Optional[dict]) -> bool:
+    try:
+        token = (auth or {}).get('token') or request.headers.get('token')
+        return token is not None and token == get_secrets_dict()['secrets'][module]['api_token']
+    except Exception as e:
+        print('Exception thrown in live event authorization check: ' + repr(e))
+        return False
+
+
+def register_live_namespaces(socketio) -> None:
+    global _socketio
+    _socketio = socketio
+    for namespace, module in LIVE_NAMESPACES.items():
+        def on_connect(auth=None, namespace=namespace, module=module):
+            if not is_authorized(module, auth):
+                return False
+            _ensure_relay_running()
+            with _clients_lock:
+                _clients[namespace][request.sid] = {'in_flight': 0, 'dropped': 0}
+
+        def on_disconnect(*args, namespace=namespace):
+            with _clients_lock:
+                _clients[namespace].pop(request.sid, None)
+
+        socketio.on_event('connect', on_connect, namespace=namespace)
+        socketio.on_event('disconnect', on_disconnect, namespace=namespace)
@@ -0,0 +1,316 @@
+from flask import Response, request
+from utils import append_to_log, authorized_via_redis_token, get_postgres_cursor_autocommit, get_postgres_engine, get_sqlalchemy_query_text, RESOURCE_ACCESS_ROLLUPS_TABLE
+from response_cache import cached_response
+from datetime import date, datetime, timedelta, timezone
+import base64
+import importlib
+import json
+import re
+import sys
+# Keyset pagination orders by (timestamp, id), so both log tables need an id column and a matching index.
+# Rollups are upserted by the log flusher in utils as access log batches are written.
+# python log_tools.py --schema applies these and every other module's schema changes. Run it before --migrate.
+LOG_SCHEMA_DDL = [
+    'alter table resource_access_logs add column if not exists id bigserial',
+    'create index if not exists resource_access_logs_timestamp_id_idx on resource_access_logs (timestamp desc, id desc)',
+    'alter table flask_logs add column if not exists id bigserial',
+    'create index if not exists flask_logs_timestamp_id_idx on flask_logs (timestamp desc, id desc)',
+    'create table if not exists ' + RESOURCE_ACCESS_ROLLUPS_TABLE + ' (granularity text, bucket_start timestamp, dimension text, key text, hits bigint, primary key (granularity, bucket_start, dimension, key))'
+]
+# Modules whose <NAME>_SCHEMA_DDL lists --schema applies, in order. Every statement is idempotent, so reruns are safe.
+SCHEMA_DDL_MODULES = [('log_tools', 'LOG_SCHEMA_DDL'), ('email_tools', 'EMAIL_SCHEMA_DDL'), ('gafg_tools', 'GAFG_SCHEMA_DDL')]
+LOG_QUERY_DEFAULT_LIMIT = 100
+LOG_QUERY_MAX_LIMIT = 1000
+ROLLUP_QUERY_MAX_ROWS = 10000
+# Rollups change with every log flush, so they are cached for a fixed time instead of invalidated. Buckets are a minute wide.
+ROLLUP_CACHE_SECONDS = 60
+
+# Both log tables are range partitioned on timestamp. Run python log_tools.py --migrate once, then --maintain daily.
+# premake is how many partitions ahead of today to keep. retention_action 'detach' keeps expired partitions as standalone tables.
+LOG_PARTITIONING = {
+    'resource_access_logs': {'interval': 'day', 'premake': 7, 'retention_days': 90, 'retention_action': 'drop'},
+    'flask_logs': {'interval': 'day', 'premake': 7, 'retention_days': 30, 'retention_action': 'drop'}
+}
+ROLLUP_MINUTE_RETENTION_DAYS = 14
+PARTITION_UPPER_BOUND_PATTERN = re.compile(r"TO \('([^']+)'\)")
+
+# Columns returned and the filters each query argument maps to, per queryable table.
+LOG_TABLES = {
+    'resource_access_logs': {
+        'columns': ['id', 'timestamp', 'location', 'ip_address'],
+        'filters': {'location': 'location like :location', 'ip': 'ip_address = :ip'}
+    },
+    'flask_logs': {
+        'columns': ['id', 'timestamp', 'category', 'level', 'message'],
+        'filters': {'category': 'category = :category', 'level': 'level = :level'}
+    }
+}
+
+
+def encode_log_cursor(timestamp, id) -> str:
+    return base64.urlsafe_b64encode(json.dumps([str(timestamp), id]).encode()).decode()
+
+
+def decode_log_cursor(cursor: str) -> list:
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+
+def parse_log_timestamp(value: str, arg: str) -> datetime:
+    """Parses an ISO 8601 timestamp into the naive UTC the log tables store. Raises ValueError naming arg if it isn't one."""
+    try:
+        parsed = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError(arg + ' must be an ISO 8601 timestamp.')
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None) if parsed.tzinfo else parsed
+
+
+def build_log_query(table: str, args: dict, limit: int) -> tuple:
+    """
+    Builds the keyset-paginated query for the table from request arguments. Only fixed SQL fragments are concatenated.
+    Raises ValueError with a message for the caller if an argument is malformed, so nothing fails once rows are streaming.
+    """
+    config = LOG_TABLES[table]
+    conditions = []
+    params = {'limit': limit}
+    if args.get('since'):
+        conditions.append('timestamp >= cast(:since as timestamp)')
+        params['since'] = parse_log_timestamp(args['since'], 'since')
+    if args.get('until'):
+        conditions.append('timestamp < cast(:until as timestamp)')
+        params['until'] = parse_log_timestamp(args['until'], 'until')
+    for arg, condition in config['filters'].items():
+        if args.get(arg):
+            conditions.append(condition)
+            params[arg] = args[arg]
+    if args.get('cursor'):
+        try:
+            cursor_timestamp, cursor_id = decode_log_cursor(args['cursor'])
+            params['cursor_timestamp'] = parse_log_timestamp(cursor_timestamp, 'cursor')
+            params['cursor_id'] = int(cursor_id)
+        except Exception:
+            raise ValueError('Invalid cursor.')
+        conditions.append('(timestamp, id) < (cast(:cursor_timestamp as timestamp), :cursor_id)')
+    query = 'select ' + ', '.join(config['columns']) + ' from ' + table
+    if conditions:
+        query += ' where ' + ' and '.join(conditions)
+    query += ' order by timestamp desc, id desc limit :limit'
+    return query, params
+
+
+def stream_log_rows(query: str, params: dict, limit: int):
+    # Rows are fetched with a server-side cursor and written out as they arrive. The next page cursor goes last.
+    # Named cursors only work inside a transaction, so this can't use the autocommit connection.
+    # The status line has been sent by the time a row fails, so errors close the JSON with an error key instead.
+    yield '{"items": ['
+    count = 0
+    last = None
+    try:
+        with get_postgres_engine('cjremmett').connect() as connection:
+            with connection.begin():
+                result = connection.execution_options(stream_results=True, yield_per=LOG_QUERY_DEFAULT_LIMIT).execute(get_sqlalchemy_query_text(query), params)
+                for row in result.mappings():
+                    yield (',' if count > 0 else '') + json.dumps(dict(row), default=str)
+                    last = row
+                    count += 1
+    except Exception as e:
+        append_to_log('flask_logs', 'LOG_TOOLS', 'ERROR', 'Exception thrown while streaming logs: ' + repr(e))
+        yield '], "next_cursor": null, "error": "Failed to read logs."}'
+        return
+    next_cursor = encode_log_cursor(last['timestamp'], last['id']) if count == limit else None
+    yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+
+
+def query_logs():
+    """
+    GET endpoint.
+    Query arguments:
+        table: resource_access_logs or flask_logs
+        since, until: timestamps bounding the results (UTC)
+        location (like pattern), ip: resource_access_logs filters
+        category, level: flask_logs filters
+        limit: page size
+        cursor: next_cursor from the previous page
+    """
+    try:
+        if not authorized_via_redis_token(request, 'log_tools'):
+            return ('', 401)
+
+        table = request.args.get('table', 'resource_access_logs')
+        if table not in LOG_TABLES:
+            return ('table must be one of ' + ', '.join(LOG_TABLES) + '.', 400)
+        limit = min(max(request.args.get('limit', LOG_QUERY_DEFAULT_LIMIT, type=int), 1), LOG_QUERY_MAX_LIMIT)
+        try:
+            query, params = build_log_query(table, request.args, limit)
+        except ValueError as e:
+            return (str(e), 400)
+        return Response(stream_log_rows(query, params, limit), status=200, content_type='application/json')
+    except Exception as e:
+        append_to_log('flask_logs', 'LOG_TOOLS', 'ERROR', 'Exception thrown in query_logs: ' + repr(e))
+        return ('', 500)
+
+
+@cached_response(ROLLUP_CACHE_SECONDS, token_module='log_tools')
+def get_resource_access_rollups():
+    """
+    GET endpoint.
+    Query arguments:
+        granularity: minute or hour
+        dimension: path or ip
+        since, until: bucket_start bounds (UTC)
+        key: only this path or IP
+    """
+    try:
+        if not authorized_via_redis_token(request, 'log_tools'):
+            return ('', 401)
+
+        granularity = request.args.get('granularity', 'hour')
+        dimension = request.args.get('dimension', 'path')
+        if granularity not in ('minute', 'hour') or dimension not in ('path', 'ip'):
+            return ('granularity must be minute or hour and dimension must be path or ip.', 400)
+        query = 'select bucket_start, key, hits from ' + RESOURCE_ACCESS_ROLLUPS_TABLE + ' where granularity = :granularity and dimension = :dimension'
+        params = {'granularity': granularity, 'dimension': dimension, 'max_rows': ROLLUP_QUERY_MAX_ROWS}
+        if request.args.get('since'):
+            query += ' and bucket_start >= cast(:since as timestamp)'
+            params['since'] = request.args['since']
+        if request.args.get('until'):
+            query += ' and bucket_start < cast(:until as timestamp)'
+            params['until'] = request.args['until']
+        if request.args.get('key'):
+            query += ' and key = :key'
+            params['key'] = request.args['key']
+        query += ' order by bucket_start desc, hits desc limit :max_rows'
+        with get_postgres_cursor_autocommit('cjremmett') as cursor:
+            rows = [dict(row) for row in cursor.execute(get_sqlalchemy_query_text(query), params).mappings()]
+        return Response(json.dumps(rows, default=str), status=200, content_type='application/json')
+    except Exception as e:
+        append_to_log('flask_logs', 'LOG_TOOLS', 'ERROR', 'Exception thrown in get_resource_access_rollups: ' + repr(e))
+        return ('', 500)
+
+
+def get_partition_start(table: str, day: date) -> date:
+    return day.replace(day=1) if LOG_PARTITIONING[table]['interval'] == 'month' else day
+
+
+def get_next_partition_start(table: str, start: date) -> date:
+    if LOG_PARTITIONING[table]['interval'] == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def get_partition_name(table: str, start: date) -> str:
+    return table + '_p' + start.strftime('%Y%m%d' if LOG_PARTITIONING[table]['interval'] == 'day' else '%Y%m')
+
+
+def create_partition(cursor, table: str, name: str, start: date, end: date) -> None:
+    bounds = "for values from ('" + start.isoformat() + "') to ('" + end.isoformat() + "')"
+    default = table + '_default'
+    if not cursor.execute(get_sqlalchemy_query_text('select to_regclass(:name) is not null'), {'name': default}).scalar():
+        cursor.execute(get_sqlalchemy_query_text('create table ' + name + ' partition of ' + table + ' ' + bounds))
+        return
+    # Postgres refuses to create a partition while the default partition holds rows in its range.
+    # Move those rows into a standalone table and attach it instead. The caller's transaction makes this atomic.
+    cursor.execute(get_sqlalchemy_query_text('lock table ' + default + ' in access exclusive mode'))
+    cursor.execute(get_sqlalchemy_query_text('create table ' + name + ' (like ' + table + ' including defaults)'))
+    cursor.execute(get_sqlalchemy_query_text('with moved as (delete from ' + default + " where timestamp >= '" + start.isoformat() + "' and timestamp < '" + end.isoformat() + "' returning *) insert into " + name + ' select * from moved'))
+    cursor.execute(get_sqlalchemy_query_text('alter table ' + table + ' attach partition ' + name + ' ' + bounds))
+
+
+def create_upcoming_partitions(cursor, table: str) -> int:
+    # Only covers today onward. Older rows live in the partitions they were written to, or the legacy partition from the migration.
+    created = 0
+    start = get_partition_start(table, datetime.now(timezone.utc).date())
+    for i in range(0, LOG_PARTITIONING[table]['premake'] + 1):
+        end = get_next_partition_start(table, start)
+        name = get_partition_name(table, start)
+        exists = cursor.execute(get_sqlalchemy_query_text('select to_regclass(:name) is not null'), {'name': name}).scalar()
+        if not exists:
+            create_partition(cursor, table, name, start, end)
+            created += 1
+        start = end
+    return created
+
+
+def get_partition_upper_bounds(cursor, table: str) -> list:
+    """Returns (partition name, upper bound timestamp string) for every range partition of the table. The default partition is skipped."""
+    query = ('select child.relname, pg_get_expr(child.relpartbound, child.oid) from pg_inherits'
+             ' join pg_class parent on parent.oid = pg_inherits.inhparent'
+             ' join pg_class child on child.oid = pg_inherits.inhrelid'
+             ' where parent.relname = :table')
+    bounds = []
+    for name, expression in cursor.execute(get_sqlalchemy_query_text(query), {'table': table}):
+        match = PARTITION_UPPER_BOUND_PATTERN.search(expression)
+        if match:
+            bounds.append((name, match.group(1)))
+    return bounds
+
+
+def expire_old_partitions(cursor, table: str) -> list:
+    """Detaches or drops partitions whose whole range is older than the table's retention. Returns the partitions removed."""
+    config = LOG_PARTITIONING[table]
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=config['retention_days'])).strftime('%Y-%m-%d %H:%M:%S')
+    expired = []
+    for name, upper_bound in get_partition_upper_bounds(cursor, table):
+        if upper_bound <= cutoff:
+            cursor.execute(get_sqlalchemy_query_text('alter table ' + table + ' detach partition ' + name))
+            if config['retention_action'] == 'drop':
+                cursor.execute(get_sqlalchemy_query_text('drop table ' + name))
+            expired.append(name)
+    return expired
+
+
+def maintain_log_partitions() -> None:
+    """Pre-creates upcoming partitions and expires old ones for every partitioned log table, one transaction per table. Run daily from cron."""
+    for table in LOG_PARTITIONING:
+        with get_postgres_engine('cjremmett').begin() as connection:
+            created = create_upcoming_partitions(connection, table)
+            expired = expire_old_partitions(connection, table)
+        append_to_log('flask_logs', 'LOG_TOOLS', 'INFO', 'Partition maintenance for ' + table + ': created ' + str(created) + ', ' + LOG_PARTITIONING[table]['retention_action'] + ' ' + str(expired) + '.')
+    with get_postgres_cursor_autocommit('cjremmett') as cursor:
+        cursor.execute(get_sqlalchemy_query_text('delete from ' + RESOURCE_ACCESS_ROLLUPS_TABLE + " where granularity = 'minute' and bucket_start < now() - make_interval(days => :days)"), {'days': ROLLUP_MINUTE_RETENTION_DAYS})
+
+
+def apply_schema() -> None:
+    """Runs every module's schema DDL in one transaction."""
+    with get_postgres_engine('cjremmett').begin() as connection:
+        for module, name in SCHEMA_DDL_MODULES:
+            for statement in getattr(importlib.import_module(module), name):
+                connection.execute(get_sqlalchemy_query_text(statement))
+            print('Applied ' + name + '.')
+
+
+def migrate_log_table_to_partitions(table: str) -> None:
+    """
+    Converts an unpartitioned log table into a range-partitioned one without copying data.
+    The old table is renamed to <table>_legacy and attached as the partition for everything before today, so retention eventually drops it.
+    New partitions from today onward and a default partition for stray timestamps are created in the same transaction.
+    """
+    legacy = table + '_legacy'
+    today = get_partition_start(table, datetime.now(timezone.utc).date()).isoformat()
+    with get_postgres_engine('cjremmett').begin() as connection:
+        partitioned = connection.execute(get_sqlalchemy_query_text("select relkind = 'p' from pg_class where relname = :table"), {'table': table}).scalar()
+        if partitioned:
+            print(table + ' is already partitioned.')
+            return
+        connection.execute(get_sqlalchemy_query_text('lock table ' + table + ' in access exclusive mode'))
+        connection.execute(get_sqlalchemy_query_text('alter table ' + table + ' rename to ' + legacy))
+        connection.execute(get_sqlalchemy_query_text('create table ' + table + ' (like ' + legacy + ' including defaults) partition by range (timestamp)'))
+        connection.execute(get_sqlalchemy_query_text('create index on ' + table + ' (timestamp desc, id desc)'))
+        # Rows at or after today would violate the legacy partition's bound, so move them to the new partitions first.
+        connection.execute(get_sqlalchemy_query_text('create table ' + table + '_default partition of ' + table + ' default'))
+        create_upcoming_partitions(connection, table)
+        connection.execute(get_sqlalchemy_query_text('with moved as (delete from ' + legacy + " where timestamp >= '" + today + "' or timestamp is null returning *) insert into " + table + ' select * from moved'))
+        connection.execute(get_sqlalchemy_query_text('alter table ' + table + ' attach partition ' + legacy + " for values from (minvalue) to ('" + today + "')"))
+    print('Partitioned ' + table + '.')
+
+
+if __name__ == '__main__':
+    if '--schema' in sys.argv or '-s' in sys.argv:
+        apply_schema()
+    elif '--migrate' in sys.argv or '-m' in sys.argv:
+        for table in LOG_PARTITIONING:
+            migrate_log_table_to_partitions(table)
+    elif '--maintain' in sys.argv or '-p' in sys.argv:
+        maintain_log_partitions()
+        print('Maintained log partitions.')
+    else:
+        print('Options:\n--schema (-s) -> Creates the tables, columns and indexes the tool modules need.\n--migrate (-m) -> Converts the log tables to partitioned tables.\n--maintain (-p) -> Creates upcoming log partitions and expires old ones.')
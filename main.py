@@ -1,17 +1,53 @@
-from flask import Flask, request
-import email_tools
-import gafg_tools
+from flask import Flask, request, g
+from functools import cached_property
 import utils
-import photography_tools
 import werkzeug
+from werkzeug.utils import import_string
 import dynamic_dns
+import job_queue
+import live_events
+import metrics
+import rate_limit
+import os
+import time
+from redis_tools import get_redis_cursor, REDIS_HOST
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_socketio import SocketIO
 from flask_cors import CORS
 
+# Tool modules are imported on their first request so a worker doesn't load pandas, PIL and the rest before it can answer /flask.
+# List modules in FLASK_PRELOAD_MODULES (or 'all') to import them up front instead. With gunicorn --preload that happens once before fork.
+LAZY_VIEW_MODULES = ['email_tools', 'gafg_tools', 'log_tools', 'photography_tools']
+PRELOAD_MODULES = [module for module in os.environ.get('FLASK_PRELOAD_MODULES', '').split(',') if module]
+
+
+class LazyView:
+    def __init__(self, import_name: str):
+        self.__module__, self.__name__ = import_name.rsplit('.', 1)
+        self.import_name = import_name
+
+    @cached_property
+    def view(self):
+        return import_string(self.import_name)
+
+    def __call__(self, *args, **kwargs):
+        return self.view(*args, **kwargs)
+
+
+def preload_modules(modules: list) -> None:
+    for module in (LAZY_VIEW_MODULES if 'all' in modules else modules):
+        import_string(module)
+
+
 app = Flask(__name__)
-socketio = SocketIO(app, path='/flask/socket.io', cors_allowed_origins='*')
+# Redis carries SocketIO emits between workers and nodes, so any of them can reach any client.
+socketio = SocketIO(app, path='/flask/socket.io', cors_allowed_origins='*', message_queue=live_events.get_message_queue_url())
+live_events.register_live_namespaces(socketio)
 CORS(app)
+# Queued check-ins may be picked up by a worker that hasn't served a gafg_tools route yet.
+job_queue.register_job_module('ioffice_checkin', 'gafg_tools')
+preload_modules(PRELOAD_MODULES)
+metrics.set_metrics_client(lambda: get_redis_cursor(host=REDIS_HOST))
 
 # Boilerplate code to trust the proxy remote IP
 # https://flask.palletsprojects.com/en/2.3.x/deploying/proxy_fix/
@@ -19,26 +55,64 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
 @app.before_request
 def before_request():
+    g.request_start = time.perf_counter()
+    # Background threads don't survive fork, so they start in the worker on its first request rather than at import.
+    job_queue.start_job_workers()
+    dynamic_dns.start_ip_monitor()
+    metrics.set_current_route(request.url_rule.rule if request.url_rule else 'unmatched')
     try:
         utils.log_resource_access(request.url, request.remote_addr)
     except:
         print('Failed to log URL and IP address for incoming request. Request stopped.')
         return ('', 500)
+    g.rate_limit = rate_limit.check_rate_limit(request)
+    if g.rate_limit is not None and not g.rate_limit['allowed']:
+        return ('Too many requests.', 429)
+
+@app.after_request
+def after_request(response):
+    if 'request_start' in g:
+        metrics.observe_request(request.url_rule.rule if request.url_rule else 'unmatched', request.method, response.status_code, time.perf_counter() - g.request_start)
+    if g.get('rate_limit') is not None:
+        response.headers.update(rate_limit.get_rate_limit_headers(g.rate_limit))
+    return response
+
+@app.teardown_request
+def teardown_request(exception):
+    metrics.clear_current_route()
 
 # Utils
 app.add_url_rule('/flask', view_func=utils.get_heartbeat, methods=['GET'])
+app.add_url_rule('/flask/metrics', view_func=utils.get_metrics, methods=['GET'])
 
 # GAFG Tools
-app.add_url_rule('/flask/gafg-tools/ioffice-checkin', view_func=gafg_tools.ioffice_checkin, methods=['POST'])
-app.add_url_rule('/flask/gafg-tools/ioffice-checkin-user-update-settings', view_func=gafg_tools.update_gafg_checkin_user_account, methods=['PUT'])
-app.add_url_rule('/flask/gafg-tools/trigger-manual-checkin-reminder', view_func=gafg_tools.trigger_manual_checkin_reminder, methods=['POST'])
-app.add_url_rule('/flask/gafg-tools/get-resource-access-logs', view_func=gafg_tools.get_resource_access_logs, methods=['GET'])
-app.add_url_rule('/flask/gafg-tools/sample-data', view_func=gafg_tools.get_sample_data, methods=['GET'])
-app.add_url_rule('/flask/gafg-tools/submit-sample-stock', view_func=gafg_tools.submit_sample_stock, methods=['POST'])
-app.add_url_rule('/flask/gafg-tools/get-sample-portfolio', view_func=gafg_tools.get_sample_portfolio, methods=['GET'])
+app.add_url_rule('/flask/gafg-tools/ioffice-checkin', view_func=LazyView('gafg_tools.ioffice_checkin'), methods=['POST'])
+app.add_url_rule('/flask/gafg-tools/ioffice-checkin-status', view_func=LazyView('gafg_tools.get_ioffice_checkin_status'), methods=['GET'])
+app.add_url_rule('/flask/gafg-tools/ioffice-checkin-user-update-settings', view_func=LazyView('gafg_tools.update_gafg_checkin_user_account'), methods=['PUT'])
+app.add_url_rule('/flask/gafg-tools/ioffice-checkin-users-bulk-update-settings', view_func=LazyView('gafg_tools.update_gafg_checkin_users_bulk'), methods=['PUT'])
+app.add_url_rule('/flask/gafg-tools/trigger-manual-checkin-reminder', view_func=LazyView('gafg_tools.trigger_manual_checkin_reminder'), methods=['POST'])
+app.add_url_rule('/flask/gafg-tools/get-resource-access-logs', view_func=LazyView('gafg_tools.get_resource_access_logs'), methods=['GET'])
+app.add_url_rule('/flask/gafg-tools/sample-data', view_func=LazyView('gafg_tools.get_sample_data'), methods=['GET'])
+app.add_url_rule('/flask/gafg-tools/submit-sample-stock', view_func=LazyView('gafg_tools.submit_sample_stock'), methods=['POST'])
+app.add_url_rule('/flask/gafg-tools/get-sample-portfolio', view_func=LazyView('gafg_tools.get_sample_portfolio'), methods=['GET'])
+
+# Log Tools
+app.add_url_rule('/flask/log-tools/query-logs', view_func=LazyView('log_tools.query_logs'), methods=['GET'])
+app.add_url_rule('/flask/log-tools/resource-access-rollups', view_func=LazyView('log_tools.get_resource_access_rollups'), methods=['GET'])
+
+# Photography Tools
+app.add_url_rule('/flask/photography-tools/exif-metadata-batch', view_func=LazyView('photography_tools.get_exif_metadata_batch'), methods=['POST'])
+app.add_url_rule('/flask/photography-tools/preview', view_func=LazyView('photography_tools.get_image_preview'), methods=['GET'])
+
+# Dynamic DNS
+app.add_url_rule('/flask/dynamic-dns/update-namecheap-dns-record', view_func=dynamic_dns.update_namecheap_dns_record, methods=['GET'])
+app.add_url_rule('/flask/dynamic-dns/update-namecheap-dns-records', view_func=dynamic_dns.update_namecheap_dns_records, methods=['POST'])
 
 # Email Tools
-app.add_url_rule('/flask/email-tools/get-outgoing-gscript-emails', view_func=email_tools.gscript_get_emails_to_send, methods=['GET'])
+app.add_url_rule('/flask/email-tools/outbox', view_func=LazyView('email_tools.get_outbox_messages'), methods=['GET'])
+app.add_url_rule('/flask/email-tools/get-outgoing-gscript-emails', view_func=LazyView('email_tools.gscript_get_emails_to_send'), methods=['GET'])
+app.add_url_rule('/flask/email-tools/claim-outgoing-gscript-emails', view_func=LazyView('email_tools.gscript_claim_emails_to_send'), methods=['POST'])
+app.add_url_rule('/flask/email-tools/ack-outgoing-gscript-emails', view_func=LazyView('email_tools.gscript_ack_sent_emails'), methods=['POST'])
 
 # [Unit]
 # Description=Gunicorn Flask Server
@@ -48,6 +122,9 @@ app.add_url_rule('/flask/email-tools/get-outgoing-gscript-emails', view_func=ema
 # WorkingDirectory=/home/cjr/flask
 # Environment="PATH=/home/cjr/flask/bin"
 # ExecStart=/home/cjr/flask/bin/gunicorn --chdir /home/cjr/flask/api/ wsgi:app --bind 0.0.0.0:5000 --worker-class eventlet -w 1
+# Add --preload with FLASK_PRELOAD_MODULES=all to import the tool modules once in the master instead of in every worker.
+# SocketIO long-polling needs every request from a client to reach the same worker, which gunicorn can't guarantee.
+# Either have clients connect with transports=['websocket'] and raise -w, or run one single-worker unit per port behind nginx with ip_hash.
 
 # [Install]
 # WantedBy=multi-user.targets
\ No newline at end of file
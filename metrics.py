@@ -0,0 +1,147 @@
+from contextlib import contextmanager
+from typing import Callable
+import os
+import threading
+import time
+# Each process accumulates metric deltas in memory and a background thread adds them to one Redis hash,
+# so /flask/metrics reports totals across every gunicorn worker without a Redis call per request.
+# Hash fields are complete Prometheus sample names, e.g. flask_requests_total{route="/flask",method="GET",status="200"}.
+METRICS_KEY = 'metrics'
+METRICS_FLUSH_INTERVAL_SECONDS = 5
+REQUEST_DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+BACKGROUND_ROUTE = 'background'
+
+METRIC_TYPES = {
+    'flask_request_duration_seconds': 'histogram',
+    'flask_requests_total': 'counter',
+    'flask_dependency_seconds_total': 'counter',
+    'flask_dependency_calls_total': 'counter',
+    'circuit_breaker_opens_total': 'counter',
+    'postgres_pool_checkouts_total': 'counter',
+    'postgres_pool_wait_seconds_total': 'counter',
+    'log_lines_total': 'counter'
+}
+
+_pending = {}
+_pending_lock = threading.Lock()
+_current = threading.local()
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+_flusher_get_client = None
+
+
+def get_sample_name(metric: str, labels: dict) -> str:
+    return metric + '{' + ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for key, value in labels.items()) + '}'
+
+
+def increment(metric: str, labels: dict, amount: float = 1.0) -> None:
+    _ensure_metrics_flusher_running()
+    sample = get_sample_name(metric, labels)
+    with _pending_lock:
+        _pending[sample] = _pending.get(sample, 0.0) + amount
+
+
+def set_current_route(route: str) -> None:
+    _current.route = route
+
+
+def get_current_route() -> str:
+    return getattr(_current, 'route', None) or BACKGROUND_ROUTE
+
+
+def clear_current_route() -> None:
+    _current.route = None
+
+
+def observe_request(route: str, method: str, status: int, seconds: float) -> None:
+    labels = {'route': route, 'method': method}
+    # Every bucket is written, even with 0, so each series always exposes the full set.
+    for bucket in REQUEST_DURATION_BUCKETS:
+        increment('flask_request_duration_seconds_bucket', dict(labels, le=str(bucket)), 1.0 if seconds <= bucket else 0.0)
+    increment('flask_request_duration_seconds_bucket', dict(labels, le='+Inf'))
+    increment('flask_request_duration_seconds_sum', labels, seconds)
+    increment('flask_request_duration_seconds_count', labels)
+    increment('flask_requests_total', dict(labels, status=str(status)))
+
+
+def record_dependency_time(dependency: str, seconds: float, calls: int = 1) -> None:
+    labels = {'dependency': dependency, 'route': get_current_route()}
+    increment('flask_dependency_seconds_total', labels, seconds)
+    if calls:
+        increment('flask_dependency_calls_total', labels, calls)
+
+
+@contextmanager
+def dependency_timer(dependency: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_dependency_time(dependency, time.perf_counter() - start)
+
+
+def flush_metrics(r) -> None:
+    global _pending
+    with _pending_lock:
+        deltas = _pending
+        _pending = {}
+    if not deltas:
+        return
+    try:
+        pipe = r.pipeline(transaction=False)
+        for sample, amount in deltas.items():
+            pipe.hincrbyfloat(METRICS_KEY, sample, amount)
+        pipe.execute()
+    except Exception:
+        # Put the deltas back so nothing is lost while Redis is unreachable.
+        with _pending_lock:
+            for sample, amount in deltas.items():
+                _pending[sample] = _pending.get(sample, 0.0) + amount
+        raise
+
+
+def get_sample_sort_key(sample: str) -> tuple:
+    # Keeps each series together with its buckets in ascending le order, which plain string sorting gets wrong.
+    name, _, labels = sample.partition('{')
+    le = ''
+    if ',le="' in labels:
+        labels, _, le = labels.partition(',le="')
+        le = le.rstrip('"}')
+    return (labels, name, float('inf') if le == '+Inf' else float(le or 0))
+
+
+def render_prometheus(r) -> str:
+    samples = r.hgetall(METRICS_KEY)
+    lines = []
+    for metric, metric_type in METRIC_TYPES.items():
+        metric_samples = sorted((sample for sample in samples if sample.split('{')[0] in (metric, metric + '_bucket', metric + '_sum', metric + '_count')), key=get_sample_sort_key)
+        if metric_samples:
+            lines.append('# TYPE ' + metric + ' ' + metric_type)
+            lines += [sample + ' ' + repr(float(samples[sample])) for sample in metric_samples]
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_flusher_loop(get_client: Callable) -> None:
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL_SECONDS)
+        try:
+            flush_metrics(get_client())
+        except Exception as e:
+            print('Flushing metrics failed. Error:' + repr(e))
+
+
+def set_metrics_client(get_client: Callable) -> None:
+    """Sets where metrics are flushed. Nothing is flushed until this is called."""
+    global _flusher_get_client
+    _flusher_get_client = get_client
+
+
+def _ensure_metrics_flusher_running() -> None:
+    # Threads don't survive fork, so each gunicorn worker starts its own flusher on its first metric.
+    global _flusher_pid
+    if _flusher_pid == os.getpid() or _flusher_get_client is None:
+        return
+    with _flusher_lock:
+        if _flusher_pid != os.getpid():
+            threading.Thread(target=metrics_flusher_loop, args=(_flusher_get_client,), name='metrics-flusher', daemon=True).start()
+            _flusher_pid = os.getpid()
@@ -1,6 +1,42 @@
-from utils import append_to_log, authorized_via_redis_token
-from PIL import Image, ExifTags
-from flask import request
+from utils import append_to_log, authorized_via_redis_token, is_log_enabled
+from redis_tools import get_redis_cursor, REDIS_HOST
+from PIL import Image, ExifTags, ImageOps
+from flask import request, Response, send_file
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+import atexit
+import hashlib
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+# EXIF is cached in Redis per path and invalidated by a change in mtime or size.
+PHOTO_EXIF_CACHE_KEY_PREFIX = 'photo:exif:'
+PHOTO_EXIF_CACHE_BATCH_SIZE = 500
+# Entries for moved or deleted photos are never read again, so every entry expires. A hit doesn't refresh it.
+PHOTO_EXIF_CACHE_TTL_SECONDS = 30 * 86400
+PHOTO_EXIF_WORKERS = os.cpu_count() or 2
+PHOTO_EXIF_CHUNK_SIZE = 16
+PHOTO_EXIF_MAX_PATHS = 20000
+# PIL can't read RAW/ARW files, so directory listings skip them.
+PHOTO_EXIF_EXTENSIONS = ('.jpg', '.jpeg', '.tif', '.tiff', '.png', '.webp')
+
+# Previews are rendered once per source version and size, then served from disk.
+PHOTO_PREVIEW_CACHE_DIR = '/home/cjr/flask/preview_cache'
+PHOTO_PREVIEW_CACHE_MAX_BYTES = 5 * 1024 * 1024 * 1024
+PHOTO_PREVIEW_PRUNE_INTERVAL_SECONDS = 60
+PHOTO_PREVIEW_SIZES = {'small': 256, 'medium': 1024, 'large': 2048}
+PHOTO_PREVIEW_FORMATS = {'jpeg': ('JPEG', 'image/jpeg'), 'webp': ('WEBP', 'image/webp')}
+PHOTO_PREVIEW_QUALITY = 85
+PHOTO_PREVIEW_MAX_AGE_SECONDS = 86400
+
+_preview_cache_last_pruned = 0.0
+_exif_process_pool = None
+_exif_process_pool_pid = None
+_exif_process_pool_lock = threading.Lock()
 
 def get_exif_metadata_from_image():
     # Cannot read RAW/ARW files
@@ -14,22 +50,294 @@ def get_exif_metadata_from_image():
         # print(type(img_exif))
         # <class 'PIL.Image.Exif'>
         exif_dict = {}
-        append_to_log('flask_logs', 'PHOTOGRAPHY', 'TRACE', type(img))
-        append_to_log('flask_logs', 'PHOTOGRAPHY', 'TRACE', type(img_exif))
+        append_to_log('flask_logs', 'PHOTOGRAPHY', 'TRACE', '%s', type(img))
+        append_to_log('flask_logs', 'PHOTOGRAPHY', 'TRACE', '%s', type(img_exif))
         if img_exif is None:
             append_to_log('flask_logs', 'PHOTOGRAPHY', 'TRACE', 'Sorry, image has no exif data.')
         else:
+            trace_tags = is_log_enabled('PHOTOGRAPHY', 'TRACE')
             for key, val in img_exif.items():
-                append_to_log('flask_logs', 'PHOTOGRAPHY', 'TRACE', str(key) + ' ' + str(val))
+                if trace_tags:
+                    append_to_log('flask_logs', 'PHOTOGRAPHY', 'TRACE', '%s %s', key, val)
                 if key in ExifTags.TAGS:
                     exif_dict[ExifTags.TAGS[key]] = val
                 else:
                     exif_dict[key] = val
 
-        append_to_log('flask_logs', 'PHOTOGRAPHY', 'TRACE', 'Sent EXIF data for image at ' + image_path)
-        append_to_log('flask_logs', 'PHOTOGRAPHY', 'TRACE', str(exif_dict))
+        append_to_log('flask_logs', 'PHOTOGRAPHY', 'TRACE', 'Sent EXIF data for image at %s', image_path)
+        append_to_log('flask_logs', 'PHOTOGRAPHY', 'TRACE', '%s', exif_dict)
         return exif_dict
 
     except Exception as e:
         append_to_log('flask_logs', 'PHOTOGRAPHY', 'ERROR', 'Exception thrown getting metadata from image. Error: ' + repr(e))
         return('', 500)
+
+
+def get_json_safe_exif_value(value):
+    # EXIF values include IFDRational and raw bytes, which json can't serialize.
+    # A rational with a zero denominator comes out as NaN, which isn't valid JSON either, so non-finite numbers become None.
+    if isinstance(value, (str, int, bool)) or value is None:
+        return value
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace').rstrip('\x00')
+    if isinstance(value, (tuple, list)):
+        return [get_json_safe_exif_value(item) for item in value]
+    try:
+        number = float(value)
+    except Exception:
+        return str(value)
+    return number if math.isfinite(number) else None
+
+
+def read_exif_from_file(image_path: str) -> dict:
+    """Runs in the process pool. Image.open only parses the header and getexif doesn't decode pixel data."""
+    try:
+        with Image.open(image_path) as img:
+            img_exif = img.getexif()
+            exif_dict = {}
+            for key, val in img_exif.items():
+                exif_dict[ExifTags.TAGS.get(key, str(key))] = get_json_safe_exif_value(val)
+            return {'path': image_path, 'exif': exif_dict}
+    except Exception as e:
+        return {'path': image_path, 'error': repr(e)}
+
+
+def get_exif_process_pool() -> ProcessPoolExecutor:
+    global _exif_process_pool, _exif_process_pool_pid
+    if _exif_process_pool is not None and _exif_process_pool_pid == os.getpid():
+        return _exif_process_pool
+    # Concurrent first requests would otherwise each start PHOTO_EXIF_WORKERS processes.
+    with _exif_process_pool_lock:
+        if _exif_process_pool is None or _exif_process_pool_pid != os.getpid():
+            _exif_process_pool = ProcessPoolExecutor(max_workers=PHOTO_EXIF_WORKERS)
+            _exif_process_pool_pid = os.getpid()
+    return _exif_process_pool
+
+
+def shutdown_exif_process_pool() -> None:
+    # Only the process that created the pool owns its children. A forked worker's inherited reference is left alone.
+    if _exif_process_pool is not None and _exif_process_pool_pid == os.getpid():
+        _exif_process_pool.shutdown(wait=False)
+
+
+atexit.register(shutdown_exif_process_pool)
+
+
+def get_exif_cache_key(image_path: str) -> str:
+    return PHOTO_EXIF_CACHE_KEY_PREFIX + hashlib.sha1(image_path.encode()).hexdigest()
+
+
+def store_exif_cache_entries(r, entries: dict) -> None:
+    pipe = r.pipeline(transaction=False)
+    for key, value in entries.items():
+        pipe.set(key, value, ex=PHOTO_EXIF_CACHE_TTL_SECONDS)
+    pipe.execute()
+
+
+def list_image_files(directory: str, recursive: bool) -> List[str]:
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        paths += [os.path.join(root, file) for file in sorted(files) if os.path.splitext(file)[1].lower() in PHOTO_EXIF_EXTENSIONS]
+        if not recursive:
+            break
+    return paths
+
+
+def stream_exif_metadata(image_paths: List[str]):
+    """
+    Yields one NDJSON line per path. Cached results keyed by (path, mtime, size) go out first, then the misses as the process pool finishes them.
+    Cache misses are written back to Redis in batches.
+    """
+    fingerprints = {}
+    for image_path in image_paths:
+        try:
+            stat = os.stat(image_path)
+            fingerprints[image_path] = [stat.st_mtime_ns, stat.st_size]
+        except OSError as e:
+            yield json.dumps({'path': image_path, 'error': repr(e)}) + '\n'
+
+    paths = list(fingerprints)
+    misses = []
+    r = None
+    try:
+        r = get_redis_cursor(host=REDIS_HOST)
+        for i in range(0, len(paths), PHOTO_EXIF_CACHE_BATCH_SIZE):
+            batch = paths[i:i + PHOTO_EXIF_CACHE_BATCH_SIZE]
+            for image_path, cached in zip(batch, r.mget([get_exif_cache_key(image_path) for image_path in batch])):
+                cached = json.loads(cached) if cached else None
+                if cached and cached['fingerprint'] == fingerprints[image_path]:
+                    yield json.dumps(cached['result']) + '\n'
+                else:
+                    misses.append(image_path)
+    except Exception as e:
+        append_to_log('flask_logs', 'PHOTOGRAPHY', 'WARNING', 'EXIF cache unavailable, extracting everything. Error: ' + repr(e))
+        r = None
+        misses = paths
+
+    pending = {}
+    for result in get_exif_process_pool().map(read_exif_from_file, misses, chunksize=PHOTO_EXIF_CHUNK_SIZE):
+        yield json.dumps(result) + '\n'
+        if r is not None and 'error' not in result:
+            pending[get_exif_cache_key(result['path'])] = json.dumps({'fingerprint': fingerprints[result['path']], 'result': result})
+            if len(pending) >= PHOTO_EXIF_CACHE_BATCH_SIZE:
+                store_exif_cache_entries(r, pending)
+                pending = {}
+    if r is not None and pending:
+        store_exif_cache_entries(r, pending)
+
+
+def get_exif_metadata_batch():
+    """
+    POST endpoint. Streams NDJSON with one {"path", "exif"} or {"path", "error"} object per image.
+    JSON keys (one of):
+        paths: list of image paths
+        directory: directory to catalogue, with optional recursive (default false)
+    """
+    try:
+        if not authorized_via_redis_token(request, 'photography_tools'):
+            return ('', 401)
+
+        json_body = request.json
+        if isinstance(json_body.get('paths'), list):
+            image_paths = [str(path) for path in json_body['paths']]
+        elif json_body.get('directory'):
+            image_paths = list_image_files(str(json_body['directory']), bool(json_body.get('recursive', False)))
+        else:
+            return ('JSON must contain a paths list or a directory.', 400)
+        if len(image_paths) > PHOTO_EXIF_MAX_PATHS:
+            return ('At most ' + str(PHOTO_EXIF_MAX_PATHS) + ' images can be read per request.', 400)
+
+        append_to_log('flask_logs', 'PHOTOGRAPHY', 'TRACE', 'Reading EXIF data for %s images.', len(image_paths))
+        return Response(stream_exif_metadata(image_paths), status=200, content_type='application/x-ndjson')
+    except Exception as e:
+        append_to_log('flask_logs', 'PHOTOGRAPHY', 'ERROR', 'Exception thrown getting batch metadata from images. Error: ' + repr(e))
+        return('', 500)
+
+
+def get_preview_cache_path(image_path: str, size: str, image_format: str) -> tuple:
+    """Returns (cache path, ETag). The key covers the source's path, mtime and size, so an edited photo gets a new entry."""
+    stat = os.stat(image_path)
+    digest = hashlib.sha256('|'.join([os.path.abspath(image_path), str(stat.st_mtime_ns), str(stat.st_size), size, image_format]).encode()).hexdigest()
+    return os.path.join(PHOTO_PREVIEW_CACHE_DIR, digest[:2], digest + '.' + image_format), digest
+
+
+def render_preview(image_path: str, size: str, image_format: str, cache_path: str) -> None:
+    max_edge = PHOTO_PREVIEW_SIZES[size]
+    with Image.open(image_path) as img:
+        # draft() lets the JPEG decoder scale down by up to 8x while decoding, so full resolution is never decoded.
+        img.draft('RGB', (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_edge, max_edge))
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Threads in the same worker can render the same preview at once, so each render writes its own temp file.
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(cache_path), suffix='.tmp', delete=False) as temp_file:
+            temp_path = temp_file.name
+            try:
+                img.save(temp_file, format=PHOTO_PREVIEW_FORMATS[image_format][0], quality=PHOTO_PREVIEW_QUALITY)
+            except Exception:
+                temp_file.close()
+                os.remove(temp_path)
+                raise
+        os.replace(temp_path, cache_path)
+
+
+def get_or_render_preview(image_path: str, size: str, image_format: str) -> tuple:
+    """Returns (cache path, ETag), rendering the preview on a miss. Hits are touched so pruning evicts the least recently used."""
+    cache_path, etag = get_preview_cache_path(image_path, size, image_format)
+    if os.path.exists(cache_path):
+        os.utime(cache_path)
+    else:
+        render_preview(image_path, size, image_format, cache_path)
+        prune_preview_cache()
+    return cache_path, etag
+
+
+def prune_preview_cache(force: bool = False) -> None:
+    # Walking the cache is cheap relative to rendering but not free, so do it at most once per interval.
+    global _preview_cache_last_pruned
+    if not force and time.monotonic() - _preview_cache_last_pruned < PHOTO_PREVIEW_PRUNE_INTERVAL_SECONDS:
+        return
+    _preview_cache_last_pruned = time.monotonic()
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(PHOTO_PREVIEW_CACHE_DIR):
+        for file in files:
+            try:
+                stat = os.stat(os.path.join(root, file))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, file)))
+                total += stat.st_size
+            except OSError:
+                pass
+    if total <= PHOTO_PREVIEW_CACHE_MAX_BYTES:
+        return
+    entries.sort()
+    # Evict down to 90% so every render doesn't trigger another prune.
+    for mtime, size, path in entries:
+        if total <= PHOTO_PREVIEW_CACHE_MAX_BYTES * 0.9:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def get_image_preview():
+    """
+    GET endpoint.
+    Query arguments:
+        path: image path
+        size: small, medium or large (default medium)
+        format: jpeg or webp (default jpeg)
+    Responses carry an ETag and Last-Modified, and If-None-Match / If-Modified-Since get a 304.
+    """
+    try:
+        if not authorized_via_redis_token(request, 'photography_tools'):
+            return ('', 401)
+
+        image_path = request.args.get('path', '')
+        size = request.args.get('size', 'medium')
+        image_format = request.args.get('format', 'jpeg')
+        if size not in PHOTO_PREVIEW_SIZES or image_format not in PHOTO_PREVIEW_FORMATS:
+            return ('size must be one of ' + ', '.join(PHOTO_PREVIEW_SIZES) + ' and format one of ' + ', '.join(PHOTO_PREVIEW_FORMATS) + '.', 400)
+        if not os.path.isfile(image_path):
+            return ('', 404)
+
+        cache_path, etag = get_or_render_preview(image_path, size, image_format)
+        return send_file(cache_path, mimetype=PHOTO_PREVIEW_FORMATS[image_format][1], etag=etag, last_modified=os.stat(image_path).st_mtime, conditional=True, max_age=PHOTO_PREVIEW_MAX_AGE_SECONDS)
+    except Exception as e:
+        append_to_log('flask_logs', 'PHOTOGRAPHY', 'ERROR', 'Exception thrown rendering image preview. Error: ' + repr(e))
+        return('', 500)
+
+
+def prewarm_preview(job: tuple) -> Optional[str]:
+    # Runs in the process pool. Returns an error string, or None on success.
+    image_path, size, image_format = job
+    try:
+        cache_path, etag = get_preview_cache_path(image_path, size, image_format)
+        if not os.path.exists(cache_path):
+            render_preview(image_path, size, image_format, cache_path)
+        return None
+    except Exception as e:
+        return image_path + ': ' + repr(e)
+
+
+def prewarm_preview_directory(directory: str, sizes: List[str], image_format: str = 'jpeg') -> None:
+    jobs = [(image_path, size, image_format) for image_path in list_image_files(directory, True) for size in sizes]
+    with ProcessPoolExecutor(max_workers=PHOTO_EXIF_WORKERS) as executor:
+        errors = [error for error in executor.map(prewarm_preview, jobs, chunksize=PHOTO_EXIF_CHUNK_SIZE) if error]
+    prune_preview_cache(force=True)
+    print('Rendered ' + str(len(jobs) - len(errors)) + ' of ' + str(len(jobs)) + ' previews.')
+    for error in errors:
+        print(error)
+
+
+if __name__ == '__main__':
+    if ('--prewarm' in sys.argv or '-p' in sys.argv) and len(sys.argv) > 2:
+        prewarm_preview_directory(sys.argv[-1], list(PHOTO_PREVIEW_SIZES))
+    else:
+        print('Options:\n--prewarm (-p) <directory> -> Renders every preview size for the images under the directory.')
@@ -0,0 +1,172 @@
+from redis_tools import get_redis_cursor, get_secrets_dict, REDIS_HOST
+from utils import append_to_log
+from typing import List, Optional
+import math
+import threading
+import time
+# Token buckets checked by before_request. Each request draws one token from its client IP's bucket, its API token module's
+# bucket and its route's bucket, and is rejected with 429 unless all three have one. One Lua script checks and draws from every
+# bucket atomically, so the limits hold across all workers and nodes.
+# Limits are (capacity, tokens refilled per second). Keys not listed use the dimension's default.
+# Override one without a restart with: HSET rate_limits <dimension>:<key> <capacity>,<per_second>
+# A <dimension>:default override applies to every key that has no limit of its own.
+RATE_LIMITS = {
+    'ip': {'default': (120, 2.0)},
+    'module': {'default': (600, 10.0), 'email_tools': (120, 2.0)},
+    'route': {'default': (1200, 20.0), '/flask/gafg-tools/ioffice-checkin': (60, 1.0)}
+}
+RATE_LIMITS_KEY = 'rate_limits'
+RATE_LIMIT_CONFIG_REFRESH_SECONDS = 10
+RATE_LIMIT_BUCKET_PREFIX = 'rate_limit:'
+RATE_LIMIT_EXEMPT_ROUTES = ['/flask/metrics']
+# When Redis fails, each process enforces the limits on its own for this long before trying Redis again.
+# Limits are per process while that lasts, so the effective limit is multiplied by the number of workers.
+RATE_LIMIT_FALLBACK_SECONDS = 10
+
+# KEYS are the buckets. ARGV holds capacity and per-second rate for each bucket in order.
+# Redis's clock is used so every worker agrees on the time. Returns allowed, limit, remaining, retry_after_ms, reset_ms,
+# where limit, remaining and reset describe the bucket with the fewest tokens left.
+TOKEN_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local allowed = 1
+local retry_ms = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local rate = tonumber(ARGV[i * 2]) / 1000
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(bucket[1]) or capacity
+    local last = tonumber(bucket[2]) or now
+    available = math.min(capacity, available + math.max(0, now - last) * rate)
+    tokens[i] = available
+    if available < 1 then
+        allowed = 0
+        retry_ms = math.max(retry_ms, math.ceil((1 - available) / rate))
+    end
+end
+local limit, remaining, reset_ms = 0, -1, 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local rate = tonumber(ARGV[i * 2]) / 1000
+    local available = tokens[i]
+    if allowed == 1 then
+        available = available - 1
+    end
+    redis.call('HSET', key, 'tokens', tostring(available), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(capacity / rate) + 1000)
+    if remaining < 0 or available < remaining then
+        limit, remaining, reset_ms = capacity, available, math.ceil((capacity - available) / rate)
+    end
+end
+return {allowed, limit, math.floor(remaining), retry_ms, reset_ms}
+"""
+
+_rate_limit_config = {'overrides': {}, 'token_modules': {}, 'next_refresh': 0.0}
+_local_buckets = {}
+_local_buckets_lock = threading.Lock()
+_fallback_until = 0.0
+_token_bucket_script = None
+
+
+def refresh_rate_limit_config() -> None:
+    """Reloads per-key overrides from Redis and rebuilds the API token to module lookup from the secrets."""
+    _rate_limit_config['next_refresh'] = time.monotonic() + RATE_LIMIT_CONFIG_REFRESH_SECONDS
+    try:
+        overrides = {}
+        for field, value in get_redis_cursor(host=REDIS_HOST).hgetall(RATE_LIMITS_KEY).items():
+            capacity, per_second = value.split(',')
+            overrides[field] = (int(capacity), float(per_second))
+        _rate_limit_config['overrides'] = overrides
+        secrets = get_secrets_dict()['secrets']
+        _rate_limit_config['token_modules'] = {value['api_token']: module for module, value in secrets.items() if isinstance(value, dict) and value.get('api_token')}
+    except Exception as e:
+        # Keep the last known settings.
+        print('Refreshing rate limits from Redis failed. Error:' + repr(e))
+
+
+def get_rate_limit(dimension: str, key: str) -> tuple:
+    overrides = _rate_limit_config['overrides']
+    if dimension + ':' + key in overrides:
+        return overrides[dimension + ':' + key]
+    if key in RATE_LIMITS[dimension]:
+        return RATE_LIMITS[dimension][key]
+    return overrides.get(dimension + ':default', RATE_LIMITS[dimension]['default'])
+
+
+def get_token_module(token: Optional[str]) -> Optional[str]:
+    return _rate_limit_config['token_modules'].get(token) if token else None
+
+
+def take_local_tokens(buckets: List[tuple]) -> tuple:
+    # Same algorithm as TOKEN_BUCKET_SCRIPT, for when Redis is unreachable.
+    now = time.monotonic()
+    with _local_buckets_lock:
+        available = []
+        retry = 0.0
+        for key, capacity, per_second in buckets:
+            tokens, last = _local_buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * per_second)
+            available.append(tokens)
+            if tokens < 1:
+                retry = max(retry, (1 - tokens) / per_second)
+        allowed = retry == 0.0
+        limit, remaining, reset = 0, -1, 0.0
+        for i in range(0, len(buckets)):
+            key, capacity, per_second = buckets[i]
+            tokens = available[i] - 1 if allowed else available[i]
+            _local_buckets[key] = (tokens, now)
+            if remaining < 0 or tokens < remaining:
+                limit, remaining, reset = capacity, tokens, (capacity - tokens) / per_second
+    return allowed, limit, int(remaining), retry, reset
+
+
+def take_tokens(buckets: List[tuple]) -> tuple:
+    """buckets are (key, capacity, per_second). Returns (allowed, limit, remaining, retry_after_seconds, reset_seconds)."""
+    global _fallback_until, _token_bucket_script
+    if time.monotonic() >= _fallback_until:
+        try:
+            r = get_redis_cursor(host=REDIS_HOST)
+            if _token_bucket_script is None:
+                _token_bucket_script = r.register_script(TOKEN_BUCKET_SCRIPT)
+            args = []
+            for key, capacity, per_second in buckets:
+                args += [capacity, per_second]
+            allowed, limit, remaining, retry_ms, reset_ms = _token_bucket_script(keys=[RATE_LIMIT_BUCKET_PREFIX + key for key, capacity, per_second in buckets], args=args, client=r)
+            if _fallback_until:
+                _fallback_until = 0.0
+                append_to_log('flask_logs', 'RATE_LIMIT', 'INFO', 'Redis is back, rate limits are shared again.')
+            return allowed == 1, limit, remaining, retry_ms / 1000, reset_ms / 1000
+        except Exception as e:
+            _fallback_until = time.monotonic() + RATE_LIMIT_FALLBACK_SECONDS
+            append_to_log('flask_logs', 'RATE_LIMIT', 'WARNING', 'Redis unavailable, enforcing rate limits per process. Error: ' + repr(e))
+    return take_local_tokens(buckets)
+
+
+def check_rate_limit(request) -> Optional[dict]:
+    """
+    Draws a token for the request. Returns None for exempt routes, otherwise a dict with allowed and the RateLimit-* values.
+    Fails open if anything unexpected goes wrong.
+    """
+    try:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        if route in RATE_LIMIT_EXEMPT_ROUTES:
+            return None
+        if time.monotonic() >= _rate_limit_config['next_refresh']:
+            refresh_rate_limit_config()
+        keys = [('ip', request.remote_addr or 'unknown'), ('route', route)]
+        module = get_token_module(request.headers.get('token'))
+        if module is not None:
+            keys.append(('module', module))
+        allowed, limit, remaining, retry_after, reset = take_tokens([(dimension + ':' + key,) + get_rate_limit(dimension, key) for dimension, key in keys])
+        return {'allowed': allowed, 'limit': limit, 'remaining': max(remaining, 0), 'retry_after': math.ceil(retry_after), 'reset': math.ceil(reset)}
+    except Exception as e:
+        append_to_log('flask_logs', 'RATE_LIMIT', 'ERROR', 'Exception thrown in check_rate_limit: ' + repr(e))
+        return None
+
+
+def get_rate_limit_headers(rate_limit: dict) -> dict:
+    headers = {'RateLimit-Limit': str(rate_limit['limit']), 'RateLimit-Remaining': str(rate_limit['remaining']), 'RateLimit-Reset': str(rate_limit['reset'])}
+    if not rate_limit['allowed']:
+        headers['Retry-After'] = str(max(rate_limit['retry_after'], 1))
+    return headers
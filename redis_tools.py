@@ -2,8 +2,32 @@ import redis
 import json
 import os
 import sys
-REDIS_HOST = '192.168.0.121'
+import time
+import threading
+import hashlib
+from metrics import record_dependency_time, get_current_route, BACKGROUND_ROUTE
+from circuit_breaker import check_circuit, record_success, record_failure
+REDIS_HOST = os.environ.get('REDIS_HOST', '192.168.0.121')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', '6379'))
+# Bounds how long one Redis call can block a worker. Blocking reads like BRPOP must use server-side timeouts below this.
+REDIS_CONNECT_TIMEOUT_SECONDS = 1
+REDIS_SOCKET_TIMEOUT_SECONDS = 2
 SECRETS_DIR = '/home/cjr/secrets'
+# load_secrets_into_redis publishes here so every worker drops its cached copy immediately.
+SECRETS_CHANNEL = 'secrets:changed'
+# Upper bound on staleness if a change notification is missed.
+SECRETS_CACHE_TTL_SECONDS = 10
+# While Redis is down, auth runs on the last known secrets and Redis is retried this often.
+SECRETS_DEGRADED_RETRY_SECONDS = 5
+# Redis hash of secrets file path -> JSON with the mtime, size and hash last loaded from it.
+SECRETS_MANIFEST_KEY = 'secrets:manifest'
+SECRETS_WATCH_INTERVAL_SECONDS = 2
+
+_redis_pools = {}
+_redis_pools_lock = threading.Lock()
+_secrets_cache = {'secrets': None, 'expires': 0.0}
+_secrets_listener_pid = None
+_secrets_listener_lock = threading.Lock()
 
 def get_json_from_file_as_dict(file):
     try:
@@ -39,20 +63,184 @@ def get_concatenated_secrets_dict(directory):
     return secrets_dict
 
 
-def get_redis_cursor(host='localhost', port=6379):
-    return redis.Redis(host, port, db=0, decode_responses=True)
+class InstrumentedConnection(redis.Connection):
+    """
+    Records time spent sending commands and reading replies as the redis dependency.
+    Background threads are skipped because their blocking reads (BRPOP, pub/sub) would swamp the numbers.
+    Connection failures and timeouts from any thread count toward the redis circuit breaker.
+    """
+    def connect(self):
+        try:
+            return super().connect()
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            record_failure('redis')
+            raise
+
+    def send_packed_command(self, command, check_health=True):
+        if get_current_route() == BACKGROUND_ROUTE:
+            return super().send_packed_command(command, check_health)
+        start = time.perf_counter()
+        try:
+            return super().send_packed_command(command, check_health)
+        finally:
+            record_dependency_time('redis', time.perf_counter() - start)
+
+    def read_response(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = super().read_response(*args, **kwargs)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            record_failure('redis')
+            raise
+        finally:
+            if get_current_route() != BACKGROUND_ROUTE:
+                record_dependency_time('redis', time.perf_counter() - start, calls=0)
+        record_success('redis')
+        return response
+
+
+def get_redis_cursor(host='localhost', port=REDIS_PORT, decode_responses=True, socket_timeout=REDIS_SOCKET_TIMEOUT_SECONDS):
+    # Clients share one connection pool per host and process instead of opening a new socket per call.
+    # Pass decode_responses=False to read binary values, and socket_timeout=None for pub/sub listeners that wait indefinitely.
+    # Raises CircuitOpenError without touching the network while the redis circuit is open.
+    check_circuit('redis')
+    key = (host, port, decode_responses, socket_timeout, os.getpid())
+    pool = _redis_pools.get(key)
+    if pool is None:
+        with _redis_pools_lock:
+            pool = _redis_pools.get(key)
+            if pool is None:
+                pool = redis.ConnectionPool(connection_class=InstrumentedConnection, host=host, port=port, db=0, decode_responses=decode_responses, socket_connect_timeout=REDIS_CONNECT_TIMEOUT_SECONDS, socket_timeout=socket_timeout)
+                _redis_pools[key] = pool
+    return redis.Redis(connection_pool=pool)
 
 
 def load_secrets_into_redis(directory):
     try:
         r = get_redis_cursor(host=REDIS_HOST)
         r.json().set('secrets', '$', get_concatenated_secrets_dict(directory))
+        r.publish(SECRETS_CHANNEL, str(time.time()))
         return True
     except:
         return False
 
 
-def get_secrets_dict():
+def get_secret_name(file):
+    return os.path.basename(file).split('.')[0]
+
+
+def get_file_fingerprint(file):
+    stat = os.stat(file)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size}
+
+
+def get_file_hash(file):
+    with open(file, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_changed_secrets_into_redis(directory):
+    """
+    Writes only the secrets whose files changed since the last load, and removes secrets whose files were deleted.
+    Files are only hashed when their mtime or size changed, and only parsed when their hash changed.
+    All writes go out in one MULTI/EXEC. Returns the number of secrets written or removed, or None on failure.
+    """
+    try:
+        r = get_redis_cursor(host=REDIS_HOST)
+        if not r.exists('secrets'):
+            return len(get_all_files_in_directory(os.path.abspath(directory))) if load_secrets_into_redis_with_manifest(directory) else None
+
+        manifest = {file: json.loads(entry) for file, entry in r.hgetall(SECRETS_MANIFEST_KEY).items()}
+        pipe = r.json().pipeline(transaction=True)
+        changes = 0
+        current_files = set(get_all_files_in_directory(os.path.abspath(directory)))
+        for file in current_files:
+            fingerprint = get_file_fingerprint(file)
+            previous = manifest.get(file)
+            if previous and previous['mtime'] == fingerprint['mtime'] and previous['size'] == fingerprint['size']:
+                continue
+            fingerprint['sha256'] = get_file_hash(file)
+            if previous and previous.get('sha256') == fingerprint['sha256']:
+                pipe.hset(SECRETS_MANIFEST_KEY, file, json.dumps(fingerprint))
+                continue
+            contents = get_json_from_file_as_dict(file)
+            if contents:
+                pipe.set('secrets', '$.secrets.' + get_secret_name(file), contents)
+                pipe.hset(SECRETS_MANIFEST_KEY, file, json.dumps(fingerprint))
+                changes += 1
+
+        for file in set(manifest) - current_files:
+            pipe.delete('secrets', '$.secrets.' + get_secret_name(file))
+            pipe.hdel(SECRETS_MANIFEST_KEY, file)
+            changes += 1
+
+        if changes > 0:
+            pipe.publish(SECRETS_CHANNEL, str(time.time()))
+        pipe.execute()
+        return changes
+    except Exception as e:
+        print('Incremental secrets load failed. Error:' + repr(e))
+        return None
+
+
+def load_secrets_into_redis_with_manifest(directory):
+    # Full load that also records the manifest so later incremental loads have something to compare against.
+    if not load_secrets_into_redis(directory):
+        return False
+    try:
+        r = get_redis_cursor(host=REDIS_HOST)
+        pipe = r.pipeline(transaction=True)
+        pipe.delete(SECRETS_MANIFEST_KEY)
+        for file in get_all_files_in_directory(os.path.abspath(directory)):
+            fingerprint = get_file_fingerprint(file)
+            fingerprint['sha256'] = get_file_hash(file)
+            pipe.hset(SECRETS_MANIFEST_KEY, file, json.dumps(fingerprint))
+        pipe.execute()
+        return True
+    except:
+        return False
+
+
+def watch_secrets_directory(directory, interval=SECRETS_WATCH_INTERVAL_SECONDS):
+    # Polls rather than using inotify so it works on any filesystem without another dependency.
+    # Unchanged files only cost a stat() per poll.
+    while True:
+        changes = load_changed_secrets_into_redis(directory)
+        if changes:
+            print('Applied ' + str(changes) + ' secrets change(s).')
+        time.sleep(interval)
+
+
+def invalidate_secrets_cache():
+    _secrets_cache['expires'] = 0.0
+
+
+def _listen_for_secrets_changes():
+    while True:
+        try:
+            pubsub = get_redis_cursor(host=REDIS_HOST, socket_timeout=None).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(SECRETS_CHANNEL)
+            for message in pubsub.listen():
+                invalidate_secrets_cache()
+        except Exception as e:
+            print('Secrets change listener disconnected. Error:' + repr(e))
+            # Anything published while disconnected was missed.
+            invalidate_secrets_cache()
+            time.sleep(5)
+
+
+def _ensure_secrets_listener_running():
+    # Threads don't survive fork, so each gunicorn worker subscribes on first use.
+    global _secrets_listener_pid
+    if _secrets_listener_pid == os.getpid():
+        return
+    with _secrets_listener_lock:
+        if _secrets_listener_pid != os.getpid():
+            threading.Thread(target=_listen_for_secrets_changes, name='secrets-listener', daemon=True).start()
+            _secrets_listener_pid = os.getpid()
+
+
+def fetch_secrets_dict():
     """
     Gets the secrets dictionary from Redis.
     If the dictionary is empty (probably because it hasn't been loaded yet), load it first then return it.
@@ -68,13 +256,45 @@ def get_secrets_dict():
             raise Exception('Failed to get secrets dictionary from Redis.')
     else:
         return secrets_list[0]
+
+
+def get_secrets_dict():
+    """
+    Gets the secrets dictionary from the in-process cache, refreshing it from Redis when it has expired.
+    The cache is also dropped whenever a change is published on SECRETS_CHANNEL.
+    """
+    _ensure_secrets_listener_running()
+    if _secrets_cache['secrets'] is not None and time.monotonic() < _secrets_cache['expires']:
+        return _secrets_cache['secrets']
+    try:
+        secrets = fetch_secrets_dict()
+        expires = time.monotonic() + SECRETS_CACHE_TTL_SECONDS
+    except Exception as e:
+        # Degraded mode: keep authorizing with the last known secrets, or the secrets files if this process never loaded them.
+        secrets = _secrets_cache['secrets']
+        if secrets is None:
+            secrets = get_concatenated_secrets_dict(SECRETS_DIR)
+        expires = time.monotonic() + SECRETS_DEGRADED_RETRY_SECONDS
+        print('Secrets unavailable from Redis, using the last known copy. Error:' + repr(e))
+    _secrets_cache['secrets'] = secrets
+    _secrets_cache['expires'] = expires
+    return secrets
     
 
 if __name__ == '__main__':
     if '--reload' in sys.argv or '-r' in sys.argv:
-        if load_secrets_into_redis(SECRETS_DIR) == True:
+        if load_secrets_into_redis_with_manifest(SECRETS_DIR) == True:
             print('Loaded secrets into Redis successfully.')
         else:
             print('Failed to load secerts into Redis.')
+    elif '--incremental' in sys.argv or '-i' in sys.argv:
+        changes = load_changed_secrets_into_redis(SECRETS_DIR)
+        if changes is not None:
+            print('Applied ' + str(changes) + ' secrets change(s).')
+        else:
+            print('Failed to load secerts into Redis.')
+    elif '--watch' in sys.argv or '-w' in sys.argv:
+        print('Watching ' + SECRETS_DIR + ' for changes every ' + str(SECRETS_WATCH_INTERVAL_SECONDS) + ' seconds.')
+        watch_secrets_directory(SECRETS_DIR)
     else:
-        print('Options:\n--reload (-r) -> Loads secrets into Redis.')
\ No newline at end of file
+        print('Options:\n--reload (-r) -> Loads secrets into Redis.\n--incremental (-i) -> Loads only changed secrets into Redis.\n--watch (-w) -> Polls for changed secrets and loads them into Redis.')
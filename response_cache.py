@@ -0,0 +1,128 @@
+from flask import request, make_response, Response
+from functools import wraps
+from typing import Callable, List, Optional
+from redis_tools import get_redis_cursor, REDIS_HOST
+import gzip
+import hashlib
+import json
+try:
+    import brotli
+except ImportError:
+    brotli = None
+# Read-only responses are cached in Redis so every gunicorn worker shares them. Entries are keyed on the path, the query
+# arguments and a hash of the caller's token, so one caller never gets another's response. Bodies are stored pre-compressed.
+# Each entry remembers the versions of its tags when it was stored. Write paths call invalidate_cache_tags, which bumps the
+# versions so older entries are ignored. If Redis is down, views run uncached and entries can go stale until their TTL expires.
+# Streamed responses are never cached, since buffering them would defeat the streaming.
+RESPONSE_CACHE_KEY_PREFIX = 'response_cache:'
+RESPONSE_CACHE_TAG_PREFIX = 'response_cache_tag:'
+RESPONSE_CACHE_MAX_BYTES = 4 * 1024 * 1024
+RESPONSE_CACHE_MIN_COMPRESS_BYTES = 512
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def get_cache_key() -> str:
+    principal = hashlib.sha256((request.headers.get('token') or '').encode()).hexdigest()
+    args = sorted((key, value) for key in request.args for value in request.args.getlist(key))
+    return RESPONSE_CACHE_KEY_PREFIX + hashlib.sha256(json.dumps([request.path, args, principal]).encode()).hexdigest()
+
+
+def get_preferred_encoding() -> str:
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return 'identity'
+
+
+def compress_body(body: bytes) -> dict:
+    encoded = {'identity': body}
+    if len(body) >= RESPONSE_CACHE_MIN_COMPRESS_BYTES:
+        encoded['gzip'] = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        if brotli is not None:
+            encoded['br'] = brotli.compress(body, quality=BROTLI_QUALITY)
+    return encoded
+
+
+def build_cached_response(body: bytes, encoding: str, status: int, mimetype: str, etag: str, cache_status: str) -> Response:
+    response = Response(body, status=status, mimetype=mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # Each encoding is a different representation, so it gets its own strong ETag.
+    response.set_etag(etag if encoding == 'identity' else etag + '-' + encoding)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.headers['X-Cache'] = cache_status
+    return response.make_conditional(request)
+
+
+def cached_response(ttl_seconds: int, tags: List[str] = (), token_module: Optional[str] = None) -> Callable:
+    """
+    Caches a view's 200 responses in Redis for ttl_seconds. Any other status passes through uncached.
+    Views behind a token pass token_module, so the token is checked before a cached response is served.
+    """
+    def decorator(view: Callable) -> Callable:
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if token_module is not None:
+                # utils imports this module, so its auth helper is imported here.
+                from utils import authorized_via_redis_token
+                if not authorized_via_redis_token(request, token_module):
+                    return ('', 401)
+            try:
+                r = get_redis_cursor(host=REDIS_HOST, decode_responses=False)
+                key = get_cache_key()
+                encoding = get_preferred_encoding()
+                pipe = r.pipeline(transaction=False)
+                pipe.hmget(key, ['etag', 'status', 'mimetype', 'versions', encoding, 'identity'])
+                if tags:
+                    pipe.mget([RESPONSE_CACHE_TAG_PREFIX + tag for tag in tags])
+                results = pipe.execute()
+                entry = results[0]
+                versions = json.dumps([(version or b'0').decode() for version in (results[1] if tags else [])])
+            except Exception as e:
+                print('Response cache unavailable, serving uncached. Error:' + repr(e))
+                return view(*args, **kwargs)
+
+            etag, status, mimetype, stored_versions, body, identity = entry
+            if etag is not None and stored_versions is not None and stored_versions.decode() == versions:
+                # Small bodies are only stored uncompressed.
+                if body is None:
+                    encoding, body = 'identity', identity
+                return build_cached_response(body, encoding, int(status), mimetype.decode(), etag.decode(), 'HIT')
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            data = response.get_data()
+            if len(data) > RESPONSE_CACHE_MAX_BYTES:
+                return response
+            encoded = compress_body(data)
+            etag = hashlib.sha256(data).hexdigest()[:32]
+            try:
+                # Stored with the tag versions read before the view ran, so an invalidation during the view makes this entry stale.
+                pipe = r.pipeline(transaction=True)
+                pipe.delete(key)
+                pipe.hset(key, mapping=dict(encoded, etag=etag, status=str(response.status_code), mimetype=response.mimetype or 'application/octet-stream', versions=versions))
+                pipe.expire(key, ttl_seconds)
+                pipe.execute()
+            except Exception as e:
+                print('Failed to store cached response. Error:' + repr(e))
+            if encoding not in encoded:
+                encoding = 'identity'
+            return build_cached_response(encoded[encoding], encoding, response.status_code, response.mimetype, etag, 'MISS')
+        return wrapper
+    return decorator
+
+
+def invalidate_cache_tags(tags: List[str]) -> None:
+    try:
+        pipe = get_redis_cursor(host=REDIS_HOST).pipeline(transaction=False)
+        for tag in tags:
+            pipe.incr(RESPONSE_CACHE_TAG_PREFIX + tag)
+        pipe.execute()
+    except Exception as e:
+        print('Failed to invalidate cached responses for ' + ', '.join(tags) + '. Error:' + repr(e))
@@ -0,0 +1,4 @@
+import os
+import sys
+# The app is a set of flat modules in the repo root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,62 @@
+import base64
+import quopri
+import random
+import pytest
+import gafg_tools
+CHECKIN_URL = 'https://gafg.iofficeconnect.com/external/api/rest/v2/reservations/checkin?token=abc&id=123'
+SENDER = '"Remmett, Christopher" <christopher.remmett@gafg.com>'
+FUZZ_CASES = 2000
+
+
+def get_checkin_email_corpus() -> dict:
+    """Forwarded check-in emails in every encoding seen so far, mapped to the URL get_checkin_url should find."""
+    link = '<a href="' + CHECKIN_URL.replace('&', '&amp;') + '" target="_blank">Check In</a>'
+    padding = '<p>' + 'Lorem ipsum dolor sit amet. ' * 400 + '</p>'
+    html_body = '<html><body>' + padding + link + padding + '</body></html>'
+    headers = 'From: ' + SENDER + '\nSubject: FW: Check in\nMIME-Version: 1.0\n'
+    multipart = headers + 'Content-Type: multipart/alternative; boundary="b"\n\n--b\nContent-Type: text/plain\n\n' + padding + '\n--b\nContent-Type: text/html; charset=utf-8\nContent-Transfer-Encoding: {encoding}\n\n{body}\n--b--\n'
+    return {
+        'raw html': (html_body, CHECKIN_URL),
+        'raw quoted-printable': (quopri.encodestring(html_body.encode()).decode(), CHECKIN_URL),
+        'plain headers': (headers + 'Content-Type: text/html\n\n' + html_body, CHECKIN_URL),
+        'quoted-printable': (multipart.format(encoding='quoted-printable', body=quopri.encodestring(html_body.encode()).decode()), CHECKIN_URL),
+        'base64': (multipart.format(encoding='base64', body=base64.encodebytes(html_body.encode()).decode()), CHECKIN_URL),
+        'no link': (headers + 'Content-Type: text/html\n\n' + padding * 50, None),
+        'oversized': (html_body * 200, None)
+    }
+
+
+@pytest.mark.parametrize('name', list(get_checkin_email_corpus()))
+def test_get_checkin_url_corpus(name):
+    raw_email, expected = get_checkin_email_corpus()[name]
+    assert gafg_tools.get_checkin_url(raw_email) == expected
+
+
+@pytest.mark.parametrize('sender, expected_email, expected_name', [
+    (SENDER, 'christopher.remmett@gafg.com', ['Christopher', 'Remmett']),
+    ('"Christopher Remmett" <christopher.remmett@gafg.com>', 'christopher.remmett@gafg.com', ['Christopher', 'Remmett']),
+    ('christopher.remmett@gafg.com', 'christopher.remmett@gafg.com', ['', ''])
+])
+def test_sender_parsing(sender, expected_email, expected_name):
+    assert gafg_tools.get_sender_email(sender) == expected_email
+    assert gafg_tools.get_sender_name(sender) == expected_name
+
+
+def test_fuzzed_emails_never_raise():
+    # Truncate, splice and corrupt corpus emails. The parsers must return, never raise.
+    rng = random.Random(0)
+    corpus = [raw_email for raw_email, expected in get_checkin_email_corpus().values()]
+    for i in range(0, FUZZ_CASES):
+        raw_email = rng.choice(corpus)
+        start = rng.randrange(0, len(raw_email))
+        mutation = rng.choice(['truncate', 'splice', 'garbage'])
+        if mutation == 'truncate':
+            raw_email = raw_email[:start]
+        elif mutation == 'splice':
+            raw_email = raw_email[:start] + rng.choice(corpus)[rng.randrange(0, 1000):]
+        else:
+            raw_email = raw_email[:start] + ''.join(chr(rng.randrange(0, 0x2FF)) for j in range(0, 64)) + raw_email[start:]
+        url = gafg_tools.get_checkin_url(raw_email)
+        assert url is None or url.startswith('https://gafg.iofficeconnect.com')
+        gafg_tools.get_sender_name(raw_email[:200])
+        gafg_tools.get_sender_email(raw_email[:200])